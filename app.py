@@ -3,9 +3,10 @@ import threading
 import os
 import sys
 import time
-import fcntl
 import atexit
-from flask import Flask, jsonify
+import hmac
+import json
+from flask import Flask, Response, jsonify, request
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -21,77 +22,114 @@ if not BOT_TOKEN:
     logger.error("BOT_TOKEN not set!")
     sys.exit(1)
 
-from database import init_db
-from handlers import (
-    source_group_handler_obj,
-    get_command_handlers,
-    group_message_handler_obj,
-    callback_handler
+from database import (
+    init_db, close_thread_connections, flush_pending_writes, reconcile_stats,
+    queue_webhook_update, pop_webhook_updates, ping_db
 )
-from config import BOT_NAME
+from handlers import register_handlers
+from config import (
+    BOT_NAME, ADMIN_ROSTER_REFRESH_INTERVAL, BROADCAST_CONCURRENCY, STATS_RECONCILE_INTERVAL,
+    WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, UPDATE_WORKERS, READY_MAX_DB_LATENCY,
+    PROFILE_TOKEN, PROFILE_MAX_SECONDS
+)
+from utils import refresh_admin_rosters
+from leases import Lease, run_exclusive, lease_status
+from reactions import reaction_dispatcher
+from ingest import ingest_pipeline
+from ratelimit import rate_governor
+import metrics
+from profiling import capture_profile, profiling_busy
+from telegram import Update
 import datetime
 
 init_db()
 BOT_START_TIME = datetime.datetime.now()
 
-LOCK_FILE = '/tmp/bot.lock'
+# Exactly one process consumes updates: whoever holds this lease. The other
+# web workers wait on it and take over within LEASE_TTL if the holder dies.
+update_lease = Lease("updates")
 
-def acquire_lock():
-    try:
-        global lock_fp
-        lock_fp = open(LOCK_FILE, 'w')
-        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        lock_fp.write(str(os.getpid()))
-        lock_fp.flush()
-        return True
-    except (IOError, OSError):
-        try:
-            with open(LOCK_FILE, 'r') as f:
-                old_pid = int(f.read().strip())
-            os.kill(old_pid, 0)
-            return False
-        except (ProcessLookupError, ValueError, FileNotFoundError, IOError):
-            try:
-                os.remove(LOCK_FILE)
-            except:
-                pass
-            return acquire_lock()
-
-def release_lock():
-    try:
-        fcntl.flock(lock_fp, fcntl.LOCK_UN)
-        lock_fp.close()
-        os.remove(LOCK_FILE)
-    except:
-        pass
-
-atexit.register(release_lock)
+atexit.register(close_thread_connections)  # only ours: daemon workers may still be using theirs
+atexit.register(flush_pending_writes)  # atexit runs in reverse, so this flushes before connections close
+atexit.register(update_lease.release)  # ...and a standby worker can take over straight away
+atexit.register(ingest_pipeline.stop)  # ...after the ingest worker has saved what it already queued
 
 bot_thread = None
 updater_instance = None
 bot_running = True
 
+# Read at scrape time by /metrics
+metrics.Gauge("bot_uptime_seconds", "Seconds since this process started.",
+              lambda: (datetime.datetime.now() - BOT_START_TIME).total_seconds())
+metrics.Gauge("bot_update_consumer", "1 if this process holds the update lease.", lambda: int(update_lease.held))
+metrics.Gauge("bot_update_queue_depth", "Updates received but not yet assigned to a lane.",
+              lambda: updater_instance.update_queue.qsize() if updater_instance else None)
+metrics.Gauge("bot_update_lane_queue_depth", "Updates waiting in the dispatcher lanes.",
+              lambda: updater_instance.dispatcher.stats()['queued'] if updater_instance else None)
+metrics.Gauge("bot_job_queue_pending", "Jobs scheduled on the job queue.",
+              lambda: len(updater_instance.job_queue.jobs()) if updater_instance else None)
+metrics.Gauge("bot_reaction_queue_depth", "Reactions waiting to be sent.", reaction_dispatcher.depth)
+metrics.Gauge("bot_ingest_queue_depth", "Source-channel documents waiting to be saved.",
+              lambda: ingest_pipeline.queue.qsize())
+metrics.Gauge("bot_api_backoff_seconds", "Flood-control pause left on outbound Bot API calls.",
+              lambda: rate_governor.stats()['backoff_remaining'])
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    logger.error("WEBHOOK_URL is set without WEBHOOK_SECRET – falling back to polling.")
+USE_WEBHOOK = bool(WEBHOOK_URL and WEBHOOK_SECRET)
+
+def drain_webhook_inbox(context):
+    """Dispatch updates that another web worker received and parked in the database."""
+    for payload in pop_webhook_updates():
+        context.update_queue.put(Update.de_json(json.loads(payload), context.bot))
+
+def start_webhook(updater):
+    """Run the dispatcher without polling; Flask's /webhook route feeds its update queue."""
+    updater.bot.get_me()  # the dispatcher needs bot.id; fail here, inside run_bot's retry loop
+    updater.bot.set_webhook(
+        url=f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True,
+        api_kwargs={'secret_token': WEBHOOK_SECRET}
+    )
+    logger.info(f"🪝 Webhook set to {WEBHOOK_URL}/webhook/***")
+    updater.job_queue.start()
+    updater.job_queue.run_repeating(drain_webhook_inbox, interval=1, first=1)
+    threading.Thread(target=updater.dispatcher.start, daemon=True, name="Dispatcher").start()
+
+def stop_webhook(updater):
+    # The webhook itself stays registered: during a redeploy the new instance has
+    # already set it, and Telegram holds updates while no instance answers.
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+
 def run_bot():
     global updater_instance
-    if not acquire_lock():
-        logger.warning("Another bot instance is already running. Exiting this thread.")
-        return
-
-    logger.info("🚀 Starting bot thread (lock acquired).")
-    from telegram.ext import Updater
+    from queue import Queue
+    from telegram.ext import Updater, ExtBot, JobQueue
     from telegram.error import Conflict
+    from ratelimit import GovernedRequest
+    from lanes import LaneDispatcher
+    from broadcast import broadcast_engine
 
     while bot_running:
+        if not update_lease.held:
+            logger.info("⏳ Waiting for the update lease...")
+            if not update_lease.acquire(blocking=True, keep_waiting=lambda: bot_running):
+                break
+            logger.info("🚀 Starting bot (update lease held).")
         try:
-            updater = Updater(BOT_TOKEN, use_context=True)
+            # All Bot API calls go through the shared rate governor
+            bot = ExtBot(BOT_TOKEN, request=GovernedRequest(
+                con_pool_size=8 + BROADCAST_CONCURRENCY + UPDATE_WORKERS))
+            # Chats are spread over UPDATE_WORKERS lanes; each chat's updates stay in order
+            dp = LaneDispatcher(bot, Queue(), job_queue=JobQueue(), lanes=UPDATE_WORKERS)
+            dp.job_queue.set_dispatcher(dp)
+            updater = Updater(dispatcher=dp, workers=None)
             updater_instance = updater
-            dp = updater.dispatcher
 
-            dp.add_handler(source_group_handler_obj)
-            for handler in get_command_handlers():
-                dp.add_handler(handler)
-            dp.add_handler(group_message_handler_obj)
-            dp.add_handler(callback_handler)
+            register_handlers(dp)
 
             # ✅ CORRECT ERROR CALLBACK (update, context)
             def error_callback(update, context):
@@ -110,21 +148,50 @@ def run_bot():
 
             dp.add_error_handler(error_callback)
 
-            logger.info("Starting polling...")
-            updater.start_polling(
-                poll_interval=1.0,
-                timeout=30,
-                drop_pending_updates=True,
-                bootstrap_retries=3
+            updater.job_queue.run_repeating(
+                refresh_admin_rosters,
+                interval=ADMIN_ROSTER_REFRESH_INTERVAL,
+                first=ADMIN_ROSTER_REFRESH_INTERVAL
             )
-            logger.info("✅ Bot is polling and ready!")
+            updater.job_queue.run_repeating(
+                lambda context: run_exclusive("maintenance", reconcile_stats),
+                interval=STATS_RECONCILE_INTERVAL,
+                first=STATS_RECONCILE_INTERVAL
+            )
+            # Picks up broadcasts whose process died once their lease expires
+            updater.job_queue.run_repeating(
+                lambda context: broadcast_engine.resume_running(context.bot),
+                interval=60,
+                first=60
+            )
+
+            if USE_WEBHOOK:
+                start_webhook(updater)
+                logger.info("✅ Bot is receiving webhooks and ready!")
+            else:
+                # start_polling also removes any webhook left from webhook mode
+                logger.info("Starting polling...")
+                updater.start_polling(
+                    poll_interval=1.0,
+                    timeout=30,
+                    drop_pending_updates=True,
+                    bootstrap_retries=3,
+                    allowed_updates=Update.ALL_TYPES  # chat_member updates are opt-in
+                )
+                logger.info("✅ Bot is polling and ready!")
 
-            while bot_running:
-                time.sleep(10)
-                logger.debug("Bot thread heartbeat - lock held")
+            broadcast_engine.resume_running(updater.bot)
 
-            updater.stop()
-            break
+            while bot_running and update_lease.held:
+                time.sleep(1)
+
+            if USE_WEBHOOK:
+                stop_webhook(updater)
+            else:
+                updater.stop()
+            ingest_pipeline.stop()
+            if bot_running:
+                logger.warning("Update lease lost – stopped consuming updates, waiting to take it back.")
 
         except Conflict as e:
             logger.error(f"Conflict on startup: {e}. Waiting 30 seconds...")
@@ -133,8 +200,9 @@ def run_bot():
             logger.exception(f"Unexpected error: {e}")
             time.sleep(10)
 
-    release_lock()
-    logger.info("Bot thread exiting, lock released.")
+    flush_pending_writes()
+    update_lease.release()
+    logger.info("Bot thread exiting, lease released.")
 
 def start_bot_thread():
     global bot_thread
@@ -150,9 +218,90 @@ def health():
     return jsonify({
         "status": "healthy" if thread_alive else "degraded",
         "bot_thread_alive": thread_alive,
-        "uptime_seconds": (datetime.datetime.now() - BOT_START_TIME).seconds
+        "uptime_seconds": int((datetime.datetime.now() - BOT_START_TIME).total_seconds()),
+        "update_consumer": update_lease.held,
+        "leases": lease_status()
     }), 200
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Ready when the bot thread is up and the database answers within READY_MAX_DB_LATENCY."""
+    started = time.perf_counter()
+    try:
+        ping_db()
+        db_error = None
+    except Exception as e:
+        db_error = str(e)
+    db_latency = time.perf_counter() - started
+    thread_alive = bot_thread.is_alive() if bot_thread else False
+    is_ready = thread_alive and db_error is None and db_latency <= READY_MAX_DB_LATENCY
+    return jsonify({
+        "ready": is_ready,
+        "bot_thread_alive": thread_alive,
+        "db_latency_ms": round(db_latency * 1000, 2),
+        "db_error": db_error
+    }), 200 if is_ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# The capture runs off the request thread: a minute of sampling inside a
+# gunicorn sync worker would trip its timeout and take the bot down with it
+_profile_job = {'thread': None, 'report': None, 'finished_at': None}
+
+def _profile_authorized():
+    token = request.headers.get('X-Profile-Token') or request.args.get('token', '')
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+def _run_profile(seconds):
+    report = capture_profile(seconds)
+    _profile_job['report'] = report or "Another profile was being captured; try again."
+    _profile_job['finished_at'] = time.time()
+
+@app.route('/debug/profile', methods=['GET'])
+def profile_endpoint():
+    """Start a capture in the background; fetch it from /debug/profile/report when done."""
+    if not _profile_authorized():
+        return "Not found", 404
+    thread = _profile_job['thread']
+    if (thread and thread.is_alive()) or profiling_busy():
+        return "A profile is already being captured", 409
+    seconds = max(1, min(request.args.get('seconds', 10, type=int), PROFILE_MAX_SECONDS))
+    _profile_job.update(report=None, finished_at=None,
+                        thread=threading.Thread(target=_run_profile, args=(seconds,), daemon=True, name="Profiler"))
+    _profile_job['thread'].start()
+    return jsonify({"capturing_seconds": seconds, "report": "/debug/profile/report"}), 202
+
+@app.route('/debug/profile/report', methods=['GET'])
+def profile_report_endpoint():
+    if not _profile_authorized():
+        return "Not found", 404
+    thread = _profile_job['thread']
+    if thread and thread.is_alive():
+        return "Still capturing", 202
+    if _profile_job['report'] is None:
+        return "No profile captured yet", 404
+    return Response(_profile_job['report'], mimetype='text/plain')
+
+@app.route('/webhook/<secret>', methods=['POST'])
+def webhook(secret):
+    if not USE_WEBHOOK or not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return "Not found", 404
+    header = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(header.encode(), WEBHOOK_SECRET.encode()):
+        return "Forbidden", 403
+    payload = request.get_json(silent=True)
+    if not payload:
+        return "Bad request", 400
+    updater = updater_instance
+    if updater is not None and updater.dispatcher.running:
+        updater.update_queue.put(Update.de_json(payload, updater.bot))
+    else:
+        # This worker doesn't hold the update lease; the one that does drains the inbox
+        queue_webhook_update(json.dumps(payload))
+    return "", 200
+
 @app.route('/', methods=['GET'])
 def index():
     return f"📚 {BOT_NAME} is running. Add me to a group to search for PDFs."
@@ -0,0 +1,296 @@
+"""Timings for the database layer on synthetic catalogs of a given size.
+
+Each size gets a catalog of files with realistic filenames plus users,
+downloads and feedback, generated from --seed and cached in --workdir so
+later runs (and other commits) time exactly the same data. Every run works
+on a fresh copy of the cached catalog.
+
+    python benchmarks/bench_db.py --sizes 10000 100000 --json before.json
+    python benchmarks/bench_db.py --sizes 10000 100000 --json after.json --compare before.json
+
+Building the 1000000-row catalog takes a few minutes the first time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database
+
+CATALOG_VERSION = 1  # bump when the generator changes so stale cached catalogs are rebuilt
+
+TITLE_WORDS = (
+    "the art of war mindset atomic habits rich dad poor power subconscious mind think and grow "
+    "history india world modern ancient physics chemistry biology mathematics guide complete "
+    "introduction to python programming data science machine learning deep secret life lessons "
+    "psychology money alchemist monk who sold his ferrari ikigai deep work focus discipline "
+    "godan gaban nirmala premchand madhushala rashmirathi kamayani gitanjali ramayana mahabharata "
+    "bhagavad gita yoga meditation health nutrition cooking stories short novel collected poems "
+    "letters diary young girl pride prejudice great expectations little women war peace crime "
+    "punishment brothers karamazov hundred years solitude old man sea animal farm brave new "
+    "upsc ssc ncert class notes solved papers general knowledge current affairs english grammar "
+    "quantitative aptitude reasoning polity economy geography environment science technology"
+).split()
+AUTHORS = (
+    "Robin Sharma", "James Clear", "Napoleon Hill", "Robert Kiyosaki", "Paulo Coelho", "Cal Newport",
+    "Munshi Premchand", "Harivansh Rai Bachchan", "Ramdhari Singh Dinkar", "Rabindranath Tagore",
+    "Jane Austen", "Charles Dickens", "Leo Tolstoy", "Fyodor Dostoevsky", "George Orwell",
+    "Aldous Huxley", "Gabriel Garcia Marquez", "Ernest Hemingway", "Louisa May Alcott", "Anne Frank",
+    "Yuval Noah Harari", "Morgan Housel", "Joseph Murphy", "Sun Tzu", "Laxmikanth", "RS Aggarwal",
+)
+CATEGORIES = ("Self-Improvement", "Hindi Novels", "English Classics", "Exam Prep", "Science",
+              "History", "Programming", "Poetry", "Spirituality", "Finance")
+LANGUAGES = ("English", "Hindi")
+PATTERNS = (
+    "{title} by {author} ({year}).pdf",
+    "{author} - {title}.pdf",
+    "{title_snake}_compressed.pdf",
+    "{title} [{language}] @booksdaily.pdf",
+    "{title} {year} Edition.pdf",
+    "{title}.pdf",
+)
+# Zipf-like word weights: a few words appear in many titles, most in few
+WORD_WEIGHTS = [1 / (rank + 1) for rank in range(len(TITLE_WORDS))]
+
+def synthetic_file(rng, n):
+    title = " ".join(rng.choices(TITLE_WORDS, WORD_WEIGHTS, k=rng.randint(2, 5))).title()
+    author = rng.choice(AUTHORS)
+    year = rng.randint(1850, 2024)
+    language = rng.choice(LANGUAGES)
+    filename = rng.choice(PATTERNS).format(
+        title=title, title_snake=title.replace(" ", "_"), author=author, year=year, language=language)
+    return {
+        "file_id": f"bench-file-{n}",
+        "file_unique_id": f"bench-unique-{n}",
+        "original_filename": filename,
+        "file_size": rng.randint(100_000, 50_000_000),
+        "message_id": n,
+        "channel_id": -1000000000001,
+        "author": author if rng.random() < 0.5 else None,
+        "category": rng.choice(CATEGORIES) if rng.random() < 0.6 else None,
+        "language": language,
+        "year": year,
+        "pages": rng.randint(40, 1200),
+    }
+
+def use_database(path):
+    """Point the database module at `path`, dropping connections and caches for the old one."""
+    database.flush_pending_writes()
+    database.close_all_connections()
+    database.DATABASE = path
+    database.invalidate_caches()
+
+def build_catalog(path, size, seed):
+    rng = random.Random(seed)
+    use_database(path)
+    database.init_db()
+    batch = []
+    for n in range(1, size + 1):
+        batch.append(synthetic_file(rng, n))
+        if len(batch) == 10_000:
+            database.add_files(batch)
+            batch = []
+    database.add_files(batch)
+
+    users = max(100, size // 10)
+    downloads = [(rng.randint(1, users), rng.randint(1, size), "2024-01-01 00:00:00") for _ in range(size // 2)]
+    feedback = [(rng.randint(1, users), rng.randint(1, size), rng.randint(1, 5), None) for _ in range(size // 20)]
+    with database.get_db() as conn:
+        conn.executemany("INSERT INTO users (user_id, first_name, username, last_interaction) VALUES (?, ?, ?, ?)",
+                         [(uid, f"Reader{uid}", f"reader{uid}", "2024-01-01 00:00:00") for uid in range(1, users + 1)])
+        conn.executemany("INSERT INTO downloads (user_id, book_id, downloaded_at) VALUES (?, ?, ?)", downloads)
+        conn.executemany("UPDATE files SET download_count = ? WHERE id = ?",
+                         [(count, book_id) for book_id, count in Counter(d[1] for d in downloads).items()])
+        conn.executemany("INSERT INTO feedback (user_id, book_id, rating, comment) VALUES (?, ?, ?, ?)", feedback)
+        conn.execute("CREATE TABLE bench_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany("INSERT INTO bench_meta VALUES (?, ?)",
+                         [("version", CATALOG_VERSION), ("size", size), ("seed", seed), ("users", users)])
+        conn.commit()
+    database.recompute_ratings()
+    database.reconcile_stats()
+    use_database(path)  # close the build connections before the file is copied
+
+def catalog_meta(path):
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return dict(conn.execute("SELECT key, value FROM bench_meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+def ensure_catalog(workdir, size, seed):
+    path = os.path.join(workdir, f"catalog-{size}-seed{seed}.db")
+    meta = catalog_meta(path) if os.path.exists(path) else None
+    if not meta or meta.get("version") != str(CATALOG_VERSION):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        print(f"Building {size}-row catalog...", flush=True)
+        started = time.perf_counter()
+        build_catalog(path, size, seed)
+        print(f"  built in {time.perf_counter() - started:.1f}s", flush=True)
+        meta = catalog_meta(path)
+    return path, meta
+
+def use_fresh_copy(catalog, run_path):
+    """Copy a cached catalog to run_path and point the database module at the copy."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(run_path + suffix):
+            os.remove(run_path + suffix)
+    shutil.copyfile(catalog, run_path)
+    use_database(run_path)
+    database.init_db()
+    return run_path
+
+def timed(func, args_list):
+    """Call func once per args tuple; returns latency stats over the calls."""
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - started
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "calls": n,
+        "ops_per_sec": n / total if total else 0.0,
+        "mean_ms": total / n * 1000,
+        "p50_ms": latencies[n // 2] * 1000,
+        "p95_ms": latencies[min(n - 1, int(n * 0.95))] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+def buffered(func):
+    """Time a write-behind call including its share of the flush that persists it."""
+    def call_and_flush(*args):
+        func(*args)
+        database.flush_pending_writes()
+    return call_and_flush
+
+def cold(func):
+    """Run func with the search cache emptied first, so each call reaches SQLite."""
+    def call(*args):
+        database.search_cache.clear()
+        return func(*args)
+    return call
+
+def query_shapes(rng, size):
+    with database.get_db(readonly=True) as conn:
+        names = [row[0] for row in conn.execute(
+            "SELECT normalized_name FROM files WHERE id IN (?, ?, ?, ?, ?)",
+            [rng.randint(1, size) for _ in range(5)])]
+    return {
+        "exact title": names,
+        "common word": ["the", "history", "mindset", "novel", "guide"],
+        "rare phrase": ["brothers karamazov", "solved papers", "rashmirathi", "ikigai deep", "monk who"],
+        "short (LIKE)": ["ai", "gk", "up", "ss", "ra"],
+        "no match": ["zzqxv", "qwertyuiop", "xylophonist", "blorptastic", "nnnnnn"],
+    }
+
+def run_size(workdir, size, seed, repeat):
+    catalog, meta = ensure_catalog(workdir, size, seed)
+    run_path = use_fresh_copy(catalog, os.path.join(workdir, "run.db"))
+
+    rng = random.Random(seed + 1)
+    users = int(meta["users"])
+    results = {}
+    per_page = database.RESULTS_PER_PAGE
+
+    for shape, queries in query_shapes(rng, size).items():
+        args = [(q, per_page, 0) for q in queries] * max(1, repeat // len(queries))
+        results[f"search_files[{shape}]"] = timed(database.search_files, args)
+    typos = [("atomc habbits",), ("rich dda poor",), ("premchnd godan",), ("histroy of inda",)]
+    results["search_files_page[typo, cold]"] = timed(cold(database.search_files_page), typos * max(1, repeat // 40))
+    results["search_files_page[cached]"] = timed(database.search_files_page, [("mindset",)] * repeat)
+
+    new_files = [synthetic_file(rng, size + n) for n in range(1, repeat + 1)]
+    results["add_file"] = timed(database.add_file, [
+        (f["file_id"], f["file_unique_id"], f["original_filename"], f["file_size"], f["message_id"],
+         f["channel_id"], f["author"], f["category"], f["language"], f["year"], f["pages"])
+        for f in new_files])
+    results["update_user[+flush]"] = timed(buffered(database.update_user), [
+        (rng.randint(1, users * 2), "Reader", "reader") for _ in range(repeat)])
+    results["increment_download[+flush]"] = timed(buffered(database.increment_download), [
+        (rng.randint(1, size), rng.randint(1, users)) for _ in range(repeat)])
+    results["increment_download[buffered]"] = timed(database.increment_download, [
+        (rng.randint(1, size), rng.randint(1, users)) for _ in range(repeat)])
+    results["get_top_books"] = timed(database.get_top_books, [(10,)] * max(1, repeat // 10))
+    database.flush_pending_writes()
+    results["get_random_book"] = timed(database.get_random_book, [()] * repeat)
+    results["get_random_book[category]"] = timed(database.get_random_book, [
+        (rng.choice(CATEGORIES),) for _ in range(repeat)])
+    results["add_feedback"] = timed(database.add_feedback, [
+        (rng.randint(1, users), rng.randint(1, size), rng.randint(1, 5), None) for _ in range(repeat)])
+
+    use_database(run_path)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(size, results, baseline=None):
+    print(f"\n{size} files")
+    header = f"{'benchmark':<34} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9}"
+    print(header + ("  p50 vs baseline" if baseline else ""))
+    for name, r in results.items():
+        line = f"{name:<34} {r['ops_per_sec']:>10.0f} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f}"
+        before = (baseline or {}).get(name)
+        if before and before["p50_ms"]:
+            line += f"  {r['p50_ms'] / before['p50_ms']:>6.2f}x"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=200, help="calls per benchmark")
+    parser.add_argument("--workdir", default=os.path.join(ROOT, ".bench"), help="where catalogs are cached")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="a previous --json file to compare p50 latencies against")
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = run_size(args.workdir, size, args.seed, args.repeat)
+        print_results(size, results[str(size)], baseline.get(str(size)))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "params": vars(args),
+                "environment": {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "sqlite": sqlite3.sqlite_version,
+                    "platform": platform.platform(),
+                    "fts": database.FTS_ENABLED,
+                },
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
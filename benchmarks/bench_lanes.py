@@ -0,0 +1,97 @@
+"""Throughput of LaneDispatcher as the number of update lanes grows.
+
+Each synthetic update goes to a handler that sleeps for --handler-ms, standing
+in for a Bot API call or a slow query. Updates are spread over --chats chats,
+and every run also checks that each chat's updates were handled in order.
+
+    python benchmarks/bench_lanes.py --updates 2000 --chats 200 --lanes 0 1 2 4 8 16
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import JobQueue, TypeHandler
+
+from lanes import LaneDispatcher
+
+class FakeBot:
+    id = 1
+    username = "bench_bot"
+    defaults = None
+    callback_data_cache = None
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Reader"},
+            "text": "#book mindset",
+        },
+    }, None)
+
+def run(lanes, updates, chats, handler_seconds):
+    seen = defaultdict(list)
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def handler(update, context):
+        time.sleep(handler_seconds)
+        with lock:
+            seen[update.effective_chat.id].append(update.update_id)
+            if sum(len(ids) for ids in seen.values()) == updates:
+                done.set()
+
+    dispatcher = LaneDispatcher(FakeBot(), Queue(), job_queue=JobQueue(), workers=1, lanes=lanes)
+    dispatcher.add_handler(TypeHandler(Update, handler))
+    batch = [make_update(i, -1000 - i % chats) for i in range(1, updates + 1)]
+
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    started = time.perf_counter()
+    for update in batch:
+        dispatcher.update_queue.put(update)
+    done.wait()
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+    thread.join()
+
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    return {"lanes": lanes, "seconds": elapsed, "updates_per_sec": updates / elapsed, "ordered": ordered}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--handler-ms", type=float, default=5.0)
+    parser.add_argument("--lanes", type=int, nargs="+", default=[0, 1, 2, 4, 8, 16])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    baseline = None
+    print(f"{args.updates} updates over {args.chats} chats, {args.handler_ms} ms per handler\n")
+    print(f"{'lanes':>5}  {'updates/s':>10}  {'speedup':>7}  ordered")
+    for lanes in args.lanes:
+        result = run(lanes, args.updates, args.chats, args.handler_ms / 1000)
+        baseline = baseline or result["updates_per_sec"]
+        result["speedup"] = result["updates_per_sec"] / baseline
+        results.append(result)
+        print(f"{lanes:>5}  {result['updates_per_sec']:>10.0f}  {result['speedup']:>6.1f}x  {result['ordered']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+"""Offline load test of the real dispatcher and handlers with synthetic or recorded updates.
+
+Updates go through LaneDispatcher and every handler from register_handlers,
+as in production. The Bot is a real ExtBot whose Request never opens a
+socket: FakeTelegram answers each Bot API call locally (after --api-ms of
+simulated latency) and counts it. Reactions, which bypass the Bot, get the
+same treatment. The database is a fresh copy of a bench_db.py catalog.
+
+Generated streams mix searches, result-page clicks, book downloads, uploads
+to a source group and plain chatter (--mix). The stream is built once from
+--seed before the first run and every --lanes value gets the same updates.
+It can be saved with --save and replayed later with --replay, as can any
+JSONL file of raw Telegram updates (e.g. captured webhook payloads).
+
+    python benchmarks/replay.py --updates 5000 --rate 200 --lanes 4
+    python benchmarks/replay.py --updates 2000 --save stream.jsonl
+    python benchmarks/replay.py --replay stream.jsonl --rate 0 --lanes 0 1 4 8 --json replay.json
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from queue import Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SOURCE_CHAT = -1009999999999
+BOT_USER = {"id": 999000, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+ADMIN_ID = 424242
+# Bot replies get this plus the id of the message they answer, so a generated
+# click can name the results message of an earlier search before it is sent
+REPLY_ID_OFFSET = 1_000_000
+
+# Read by config at import time: never the real token, and uploads come from SOURCE_CHAT
+os.environ["BOT_TOKEN"] = f"{BOT_USER['id']}:REPLAY-offline-token"
+os.environ["SOURCE_CHANNELS"] = str(SOURCE_CHAT)
+
+from telegram import Update
+from telegram.ext import ExtBot, JobQueue, TypeHandler
+from telegram.utils.request import Request
+
+import database
+import metrics
+import utils
+from bench_db import TITLE_WORDS, WORD_WEIGHTS, ensure_catalog, synthetic_file, use_fresh_copy
+from config import UPDATE_WORKERS
+from handlers import register_handlers
+from ingest import ingest_pipeline
+from lanes import LaneDispatcher
+from ratelimit import GovernedRequest
+
+logger = logging.getLogger("replay")
+
+DEFAULT_MIX = "search=35,page=15,get=15,upload=5,chatter=30"
+
+def chat_dict(chat_id):
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"Replay {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": "Reader"}
+
+def user_dict(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Reader{user_id}", "username": f"reader{user_id}"}
+
+class FakeTelegram:
+    """Answers Bot API calls in-process and counts them."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._next_ids = defaultdict(lambda: 1000 * REPLY_ID_OFFSET)  # other bot messages, per chat
+        self._lock = threading.Lock()
+
+    def call(self, method, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+        answer = getattr(self, f"_{method}", None)
+        return answer(data) if answer else True
+
+    def _message(self, data, message_id=None):
+        try:
+            chat_id = int(data.get("chat_id", 0))
+        except ValueError:
+            chat_id = 0  # @username chats
+        if message_id is None and data.get("reply_to_message_id"):
+            message_id = REPLY_ID_OFFSET + int(data["reply_to_message_id"])
+        if message_id is None:
+            with self._lock:
+                self._next_ids[chat_id] += 1
+                message_id = self._next_ids[chat_id]
+        return {"message_id": message_id, "date": int(time.time()), "chat": chat_dict(chat_id),
+                "from": BOT_USER, "text": data.get("text") or data.get("caption") or ""}
+
+    def _getMe(self, data):
+        return BOT_USER
+
+    def _sendMessage(self, data):
+        return self._message(data)
+
+    _sendDocument = _sendPhoto = _sendMessage
+
+    def _editMessageText(self, data):
+        return self._message(data, int(data["message_id"]))
+
+    def _copyMessage(self, data):
+        return {"message_id": self._message(data)["message_id"]}
+
+    def _getChatAdministrators(self, data):
+        return [{"user": user_dict(ADMIN_ID), "status": "creator", "is_anonymous": False}]
+
+    def _getChatMember(self, data):
+        return {"user": user_dict(int(data["user_id"])), "status": "member"}
+
+class FakeRequest(GovernedRequest):
+    """A Request that hands every call to FakeTelegram instead of the network.
+
+    With governed=True calls still pass through rate_governor first, so the
+    run is paced by the same Bot API limits as production.
+    """
+
+    __slots__ = ('telegram', 'governed')
+
+    def __init__(self, telegram, governed=False, **kwargs):
+        super().__init__(**kwargs)
+        self.telegram = telegram
+        self.governed = governed
+
+    def post(self, url, data, timeout=None):
+        if self.governed:
+            return super().post(url, data, timeout=timeout)
+        return Request.post(self, url, data, timeout=timeout)
+
+    def _request_wrapper(self, method, url, *args, **kwargs):
+        data = json.loads(kwargs["body"]) if "body" in kwargs else kwargs.get("fields") or {}
+        result = self.telegram.call(url.rsplit("/", 1)[-1], data)
+        return json.dumps({"ok": True, "result": result}).encode()
+
+class FakeSession:
+    """Stands in for utils.http_session, which send_reaction uses instead of the Bot."""
+
+    class _Response:
+        def json(self):
+            return {"ok": True, "result": True}
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    def post(self, url, json=None, **kwargs):
+        self.telegram.call(url.rsplit("/", 1)[-1], json or {})
+        return self._Response()
+
+class Workload:
+    """Generates raw update dicts from the seed alone, so every run gets the same stream.
+
+    Clicks target the results message of an earlier search in the stream,
+    named by its deterministic reply id; if that search found nothing, or
+    hasn't been answered yet when the click arrives, the handler takes the
+    same path a stale button would.
+    """
+
+    def __init__(self, rng, chats, users, mix, catalog_size, recent_searches=1000):
+        self.rng = rng
+        self.chats = [-1002000000000 - i for i in range(chats)]
+        self.users = users
+        self.kinds, self.weights = zip(*mix.items())
+        self.catalog_size = catalog_size
+        self._searches = deque(maxlen=recent_searches)  # (chat_id, message_id) of searches sent
+        self._message_ids = defaultdict(int)
+        self._uploads = 0
+
+    def _message(self, update_id, chat_id, user_id, **fields):
+        self._message_ids[chat_id] += 1
+        message = {"message_id": self._message_ids[chat_id], "date": int(time.time()),
+                   "chat": chat_dict(chat_id), "from": user_dict(user_id)}
+        message.update(fields)
+        return {"update_id": update_id, "message": message}
+
+    def _query(self):
+        rng = self.rng
+        shape = rng.random()
+        if shape < 0.7:
+            return " ".join(rng.choices(TITLE_WORDS, WORD_WEIGHTS, k=rng.randint(1, 3)))
+        if shape < 0.85:
+            word = list(rng.choice(TITLE_WORDS) + rng.choice(TITLE_WORDS))
+            i = rng.randrange(len(word) - 1)
+            word[i], word[i + 1] = word[i + 1], word[i]  # a typo
+            return "".join(word)
+        return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=8))
+
+    def next(self, update_id):
+        rng = self.rng
+        kind = rng.choices(self.kinds, self.weights)[0]
+        user_id = rng.randint(1, self.users)
+        if kind in ("page", "get") and not self._searches:
+            kind = "search"  # nothing to click on yet
+
+        if kind == "search":
+            chat_id = rng.choice(self.chats)
+            if rng.random() < 0.5:
+                update = self._message(update_id, chat_id, user_id, text=f"#book {self._query()}")
+            else:
+                update = self._message(update_id, chat_id, user_id, text=f"/book {self._query()}",
+                                       entities=[{"type": "bot_command", "offset": 0, "length": 5}])
+            self._searches.append((chat_id, update["message"]["message_id"]))
+            return update
+        if kind == "chatter":
+            text = " ".join(rng.choices(TITLE_WORDS, k=rng.randint(2, 12)))
+            if rng.random() < 0.03:
+                text += " https://t.me/some_spam"
+            return self._message(update_id, rng.choice(self.chats), user_id, text=text)
+        if kind == "upload":
+            self._uploads += 1
+            book = synthetic_file(rng, self._uploads)
+            return self._message(update_id, SOURCE_CHAT, ADMIN_ID, document={
+                "file_id": f"replay-file-{update_id}", "file_unique_id": f"replay-unique-{update_id}",
+                "file_name": book["original_filename"], "file_size": book["file_size"],
+                "mime_type": "application/pdf"})
+
+        chat_id, search_id = rng.choice(self._searches)
+        data = "page_1" if kind == "page" else f"get_{rng.randint(1, self.catalog_size)}"
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user_dict(user_id), "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": REPLY_ID_OFFSET + search_id, "date": int(time.time()),
+                        "chat": chat_dict(chat_id), "from": BOT_USER, "text": "results"},
+        }}
+
+def update_kind(payload):
+    query = payload.get("callback_query")
+    if query:
+        return (query.get("data") or "").split("_", 1)[0] or "callback"
+    message = payload.get("message") or {}
+    if message.get("document"):
+        return "upload"
+    text = (message.get("text") or "").lower()
+    if text.startswith(("#book", "/book")):
+        return "search"
+    return "chatter"
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"search", "page", "get", "upload", "chatter"}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown update kinds: {', '.join(sorted(unknown))}")
+    return mix
+
+class LockErrorCounter(logging.Handler):
+    """Counts logged 'database is locked' errors, the visible end of SQLite write contention."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        if "database is locked" in record.getMessage():
+            self.count += 1
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def latency_summary(values):
+    return {"count": len(values), "p50_ms": percentile(values, 0.5) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000, "max_ms": max(values, default=0.0) * 1000}
+
+def bucket_percentile(buckets, counts, total, q):
+    """Upper bound of the histogram bucket holding the q-th observation."""
+    target, seen = total * q, 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        if seen >= target:
+            return bound
+    return float("inf")
+
+def db_contention(before, after, elapsed):
+    """Per connection mode: sessions, time held and its share of wall time, from DB_LATENCY."""
+    report = {}
+    for key, (counts, total, count) in after.items():
+        old_counts, old_total, old_count = before.get(key, ([0] * len(counts), 0.0, 0))
+        counts = [new - old for new, old in zip(counts, old_counts)]
+        total, count = total - old_total, count - old_count
+        if not count:
+            continue
+        report[key[0]] = {
+            "sessions": count,
+            "held_seconds": total,
+            "mean_ms": total / count * 1000,
+            "p99_ms_upper": bucket_percentile(metrics.DB_LATENCY.buckets, counts, count, 0.99) * 1000,
+            # Above 1.0 sessions overlapped; for "rw" that means writers queued on SQLite's lock
+            "busy_share": total / elapsed if elapsed else 0.0,
+        }
+    return report
+
+def load_stream(args):
+    """The updates every run sends: read from --replay, or generated from --seed."""
+    if args.replay:
+        with open(args.replay) as f:
+            payloads = [json.loads(line) for line in f if line.strip()]
+        return payloads[:args.updates] if args.updates else payloads
+    workload = Workload(random.Random(args.seed), args.chats, args.users, args.mix, args.catalog_size)
+    return [workload.next(update_id) for update_id in range(1, args.updates + 1)]
+
+def run(args, lanes, catalog, stream):
+    use_fresh_copy(catalog, os.path.join(args.workdir, "replay.db"))
+    # Every run starts as cold as the first: sessions from an earlier run would match this one's clicks
+    utils.search_sessions.clear()
+    utils.subscription_cache.clear()
+    with utils._admin_rosters_lock:
+        utils._admin_rosters.clear()
+        utils._admin_roster_retry.clear()
+    telegram = FakeTelegram(args.api_ms / 1000)
+    utils.http_session = FakeSession(telegram)
+    bot = ExtBot(os.environ["BOT_TOKEN"], request=FakeRequest(telegram, governed=args.governed))
+    dispatcher = LaneDispatcher(bot, Queue(), job_queue=JobQueue(), workers=1, lanes=lanes)
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    register_handlers(dispatcher)
+
+    lock = threading.Lock()
+    all_done = threading.Event()
+    enqueued, kinds = {}, {}
+    end_to_end = defaultdict(list)
+    handler_times = defaultdict(list)
+    errors = Counter()
+    state = {"done": 0, "total": None, "last": 0.0}
+
+    def timed_callback(name, callback):
+        @functools.wraps(callback)
+        def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                elapsed = time.perf_counter() - started
+                with lock:
+                    handler_times[name].append(elapsed)
+        return timed
+
+    instrumented = {handler: handler.callback for handler in dispatcher.handlers[0]}
+    for handler, callback in instrumented.items():
+        handler.callback = timed_callback(metrics.handler_name(handler), callback)
+
+    def finished(update, context):
+        now = time.perf_counter()
+        with lock:
+            end_to_end[kinds.pop(update.update_id)].append(now - enqueued.pop(update.update_id))
+            state["done"] += 1
+            state["last"] = now
+            if state["done"] == state["total"]:
+                all_done.set()
+
+    def failed(update, context):
+        name = type(context.error).__name__
+        with lock:
+            errors[name] += 1
+            first = errors[name] == 1
+        if first:
+            logger.warning(f"Handler error on update {getattr(update, 'update_id', '?')}: {context.error!r}",
+                           exc_info=context.error)
+
+    dispatcher.add_handler(TypeHandler(Update, finished), group=1)
+    dispatcher.add_error_handler(failed)
+
+    lock_errors = LockErrorCounter()
+    logging.getLogger().addHandler(lock_errors)
+    db_before = metrics.DB_LATENCY.snapshot()
+    dispatcher.job_queue.start()
+    thread = threading.Thread(target=dispatcher.start, daemon=True, name="ReplayDispatcher")
+    thread.start()
+
+    sent = 0
+    started = time.perf_counter()
+    for payload in stream:
+        if args.rate:
+            delay = started + sent / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(payload, bot)
+        with lock:
+            kinds[update.update_id] = update_kind(payload)
+            enqueued[update.update_id] = time.perf_counter()
+        dispatcher.update_queue.put(update)
+        sent += 1
+    offered = time.perf_counter() - started
+    with lock:
+        state["total"] = sent
+        if state["done"] == sent:
+            all_done.set()
+    completed = all_done.wait(args.timeout)
+
+    elapsed = (state["last"] or time.perf_counter()) - started
+    dispatcher.stop()
+    thread.join()
+    for handler, callback in instrumented.items():
+        handler.callback = callback  # the module-level handlers are registered again by the next run
+    dispatcher.job_queue.stop()
+    ingest_pipeline.stop()
+    database.flush_pending_writes()
+    logging.getLogger().removeHandler(lock_errors)
+
+    all_latencies = [value for values in end_to_end.values() for value in values]
+    return {
+        "lanes": lanes,
+        "updates": sent,
+        "handled": state["done"],
+        "completed": completed,
+        "seconds": elapsed,
+        "offered_per_sec": sent / offered if offered else 0.0,
+        "updates_per_sec": state["done"] / elapsed if elapsed else 0.0,
+        "latency": latency_summary(all_latencies),
+        "latency_by_kind": {kind: latency_summary(values) for kind, values in sorted(end_to_end.items())},
+        "handler_latency": {name: latency_summary(values) for name, values in sorted(handler_times.items())},
+        "handler_errors": dict(errors),
+        "db": db_contention(db_before, metrics.DB_LATENCY.snapshot(), elapsed),
+        "db_locked_errors": lock_errors.count,
+        "api_calls": dict(telegram.calls.most_common()),
+        "ingest": {key: value for key, value in ingest_pipeline.stats().items()
+                   if key in ("saved", "duplicates", "failed", "batches", "lag_p50", "lag_p95")},
+    }
+
+def print_result(result):
+    lat = result["latency"]
+    status = "" if result["completed"] else f"  (timed out: {result['handled']}/{result['updates']} handled)"
+    print(f"\nlanes={result['lanes']}: {result['updates_per_sec']:.0f} updates/s "
+          f"(offered {result['offered_per_sec']:.0f}/s), p50 {lat['p50_ms']:.1f} ms, p99 {lat['p99_ms']:.1f} ms{status}")
+    print(f"  {'kind':<10} {'count':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for kind, lat in result["latency_by_kind"].items():
+        print(f"  {kind:<10} {lat['count']:>6} {lat['p50_ms']:>8.1f} {lat['p99_ms']:>8.1f}")
+    print(f"  {'handler':<28} {'calls':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, lat in result["handler_latency"].items():
+        print(f"  {name:<28} {lat['count']:>6} {lat['p50_ms']:>8.2f} {lat['p99_ms']:>8.2f}")
+    for mode, db in sorted(result["db"].items()):
+        print(f"  db {mode}: {db['sessions']} sessions, mean {db['mean_ms']:.2f} ms, "
+              f"p99 <= {db['p99_ms_upper']:.1f} ms, busy {db['busy_share']:.0%}")
+    if result["db_locked_errors"] or result["handler_errors"]:
+        print(f"  errors: {result['db_locked_errors']} 'database is locked', handlers {result['handler_errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000, help="updates to send (with --replay: at most)")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second to offer; 0 = as fast as possible")
+    parser.add_argument("--lanes", type=int, nargs="+", default=[UPDATE_WORKERS])
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"default {DEFAULT_MIX}")
+    parser.add_argument("--api-ms", type=float, default=20.0, help="simulated Bot API latency per call")
+    parser.add_argument("--governed", action="store_true", help="pace Bot API calls with rate_governor")
+    parser.add_argument("--catalog-size", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", default=os.path.join(ROOT, ".bench"), help="where catalogs are cached")
+    parser.add_argument("--replay", help="JSONL file of raw updates to send instead of a generated stream")
+    parser.add_argument("--save", help="write the stream to this JSONL file")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for handlers after sending")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=args.log_level)
+    os.makedirs(args.workdir, exist_ok=True)
+
+    catalog, _ = ensure_catalog(args.workdir, args.catalog_size, args.seed)
+    if args.replay:
+        source = f"updates replayed from {args.replay}"
+    else:
+        source = f"{args.updates} generated updates ({', '.join(f'{k}={v:g}' for k, v in args.mix.items())})"
+    print(f"{source}, {args.api_ms} ms API latency, {args.catalog_size}-book catalog")
+    stream = load_stream(args)
+    if args.save:
+        with open(args.save, "w") as f:
+            f.writelines(json.dumps(payload) + "\n" for payload in stream)
+    results = []
+    for lanes in args.lanes:
+        results.append(run(args, lanes, catalog, stream))
+        print_result(results[-1])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"params": {**vars(args), "mix": args.mix}, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
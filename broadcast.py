@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import Unauthorized, BadRequest, RetryAfter
+from config import BROADCAST_CONCURRENCY, BROADCAST_BATCH_SIZE
+from database import (
+    create_broadcast_job, get_broadcast_job, get_running_broadcast_jobs,
+    get_broadcast_recipients, save_broadcast_progress, finish_broadcast_job
+)
+from utils import log_to_channel
+from leases import Lease
+
+logger = logging.getLogger(__name__)
+
+# BadRequest descriptions that mean the user can never receive a message from us
+UNREACHABLE_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "bot can't initiate")
+
+class BroadcastEngine:
+    """Runs broadcast jobs in the background with bounded concurrency.
+
+    Job state and the per-recipient cursor live in the broadcast_jobs table,
+    so a restart resumes each running job after its last finished batch.
+    Each job runs under its own lease, so only one process sends it and a
+    job orphaned by a dead process is picked up by the next resume_running.
+    Pacing is left to the rate governor behind the bot's Request.
+    """
+
+    def __init__(self, concurrency=BROADCAST_CONCURRENCY, batch_size=BROADCAST_BATCH_SIZE):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._threads = {}     # job_id -> thread
+        self._cancelled = set()
+        self._progress = {}    # job_id -> (started monotonic, recipients handled this run)
+
+    def start_job(self, bot, message, report_chat_id, active_days=None):
+        job_id = create_broadcast_job(message, report_chat_id, active_days)
+        self._spawn(bot, job_id)
+        return job_id
+
+    def resume_running(self, bot):
+        """Restart every job that was still running when the process stopped."""
+        for job in get_running_broadcast_jobs():
+            logger.info(f"📢 Resuming broadcast #{job['id']} after user {job['cursor']}")
+            self._spawn(bot, job['id'])
+
+    def cancel(self, job_id):
+        with self._lock:
+            if job_id not in self._threads:
+                return False
+            self._cancelled.add(job_id)
+            return True
+
+    def is_running(self, job_id):
+        with self._lock:
+            thread = self._threads.get(job_id)
+        return thread is not None and thread.is_alive()
+
+    def progress(self, job_id):
+        """Job row plus live throughput (recipients/s) and ETA in seconds."""
+        job = get_broadcast_job(job_id)
+        if not job:
+            return None
+        done = job['sent'] + job['failed'] + job['blocked']
+        job['done'] = done
+        job['rate'] = 0.0
+        job['eta'] = None
+        started, handled = self._progress.get(job_id, (None, 0))
+        if started is not None:
+            elapsed = time.monotonic() - started
+            if elapsed > 0 and handled:
+                job['rate'] = handled / elapsed
+                job['eta'] = max(0, job['total'] - done) / job['rate']
+        return job
+
+    def _spawn(self, bot, job_id):
+        with self._lock:
+            if job_id in self._threads and self._threads[job_id].is_alive():
+                return
+            thread = threading.Thread(target=self._run, args=(bot, job_id), daemon=True,
+                                      name=f"Broadcast-{job_id}")
+            self._threads[job_id] = thread
+        thread.start()
+
+    def _send(self, bot, user_id, message):
+        for _ in range(2):
+            try:
+                bot.send_message(user_id, message)
+                return "sent"
+            except RetryAfter:
+                continue  # the governor has paused sends; the retry waits there
+            except Unauthorized:
+                return "blocked"
+            except BadRequest as e:
+                if any(err in str(e).lower() for err in UNREACHABLE_ERRORS):
+                    return "blocked"
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+            except Exception as e:
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+        return "failed"
+
+    def _run(self, bot, job_id):
+        lease = Lease(f"broadcast:{job_id}")
+        if not lease.acquire():
+            with self._lock:
+                self._threads.pop(job_id, None)
+            return  # another process is sending this job
+        self._progress[job_id] = (time.monotonic(), 0)
+        status = "done"
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency,
+                                    thread_name_prefix=f"Broadcast-{job_id}") as pool:
+                while True:
+                    if job_id in self._cancelled:
+                        status = "cancelled"
+                        break
+                    if not lease.held:
+                        logger.warning(f"📢 Broadcast #{job_id} lost its lease; leaving it to another process")
+                        return
+                    job = get_broadcast_job(job_id)
+                    recipients = get_broadcast_recipients(job, self.batch_size)
+                    if not recipients:
+                        break
+                    results = list(pool.map(lambda uid: self._send(bot, uid, job['message']), recipients))
+                    blocked = [uid for uid, result in zip(recipients, results) if result == "blocked"]
+                    save_broadcast_progress(job_id, recipients[-1], results.count("sent"),
+                                            results.count("failed"), blocked)
+                    started, handled = self._progress[job_id]
+                    self._progress[job_id] = (started, handled + len(recipients))
+            finish_broadcast_job(job_id, status)
+        except Exception as e:
+            logger.exception(f"Broadcast #{job_id} stopped: {e}")
+            return  # stays 'running' so the next start resumes it
+        finally:
+            lease.release()
+            with self._lock:
+                self._threads.pop(job_id, None)
+                self._cancelled.discard(job_id)
+
+        job = self.progress(job_id)
+        summary = (f"📢 Broadcast #{job_id} {status}: {job['sent']} sent, "
+                   f"{job['blocked']} blocked, {job['failed']} failed of {job['total']} hearts.")
+        logger.info(summary)
+        try:
+            if job['report_chat_id']:
+                bot.send_message(job['report_chat_id'], summary)
+        except Exception as e:
+            logger.error(f"Broadcast report failed: {e}")
+        log_to_channel(bot, summary)
+
+broadcast_engine = BroadcastEngine()
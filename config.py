@@ -22,4 +22,82 @@ DATABASE = "bot_data.db"
 
 # Flood control settings (seconds)
 MESSAGE_RETRY_DELAY = int(os.getenv("MESSAGE_RETRY_DELAY", "5"))      # Base delay for message retry
-REACTION_DELAY = float(os.getenv("REACTION_DELAY", "0.8"))            # Delay between reactions
+REACTION_DELAY = float(os.getenv("REACTION_DELAY", "0.8"))            # Min delay between reactions in one chat
+REACTION_WORKERS = int(os.getenv("REACTION_WORKERS", "4"))            # Threads sending reactions
+REACTION_QUEUE_SIZE = int(os.getenv("REACTION_QUEUE_SIZE", "1000"))   # Pending reactions before new ones are dropped
+REACTION_MAX_AGE = float(os.getenv("REACTION_MAX_AGE", "30"))         # Drop reactions not sent within this many seconds
+
+# Database tuning
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))          # Seconds to wait on a locked database
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))       # Page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # Bytes of the DB file to memory-map
+
+# Search result cache
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))      # Max cached result pages
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "300"))         # Seconds a cached page stays valid
+
+# Typo-tolerant (trigram) search fallback
+FUZZY_MIN_SIMILARITY = float(os.getenv("FUZZY_MIN_SIMILARITY", "0.5"))  # Share of query trigrams a title must contain
+FUZZY_CANDIDATES = int(os.getenv("FUZZY_CANDIDATES", "200"))            # Titles sharing the most query trigrams to score
+FUZZY_MAX_POSTINGS = int(os.getenv("FUZZY_MAX_POSTINGS", "10000"))       # Trigram index rows read per query, rarest trigrams first
+FUZZY_MAX_RESULTS = int(os.getenv("FUZZY_MAX_RESULTS", "50"))
+
+# Write-behind buffering
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "5"))      # Seconds between background flushes
+USER_FLUSH_MAX_PENDING = int(os.getenv("USER_FLUSH_MAX_PENDING", "500"))  # Flush early once this many users are buffered
+DOWNLOAD_FLUSH_MAX_PENDING = int(os.getenv("DOWNLOAD_FLUSH_MAX_PENDING", "1000"))  # ...or this many downloads
+
+# Settings cache
+SETTINGS_REFRESH_INTERVAL = float(os.getenv("SETTINGS_REFRESH_INTERVAL", "1"))  # Seconds between checks for writes by other processes
+
+# Force-subscribe membership cache
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", "600"))                    # Seconds to trust "is a member"
+SUB_CACHE_NEGATIVE_TTL = int(os.getenv("SUB_CACHE_NEGATIVE_TTL", "60"))   # Seconds to trust "not a member"
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "50000"))
+
+# Per-chat admin roster (link-spam exemption)
+ADMIN_ROSTER_REFRESH_INTERVAL = int(os.getenv("ADMIN_ROSTER_REFRESH_INTERVAL", "600"))  # Seconds between roster refreshes
+ADMIN_ROSTER_RETRY_AFTER = int(os.getenv("ADMIN_ROSTER_RETRY_AFTER", "60"))            # Seconds before refetching a roster that failed
+
+# Bot API rate governor (Telegram's documented limits)
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))                          # Sends per second, all chats
+API_PRIVATE_CHAT_RATE = float(os.getenv("API_PRIVATE_CHAT_RATE", "1"))               # Sends per second, one private chat
+API_GROUP_CHAT_RATE_PER_MIN = float(os.getenv("API_GROUP_CHAT_RATE_PER_MIN", "20"))  # Sends per minute, one group
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "3"))                               # Sends allowed back-to-back in one chat
+
+# Broadcast engine
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))   # Sends in flight at once
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))   # Recipients per checkpoint
+
+# Materialized stats
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))  # Seconds between full recounts
+
+# Random picks
+RANDOM_POOL_TTL = int(os.getenv("RANDOM_POOL_TTL", "600"))  # Seconds before a /random id pool is reloaded
+RANDOM_POOL_MAX = int(os.getenv("RANDOM_POOL_MAX", "64"))  # Most (category, language) pools kept in memory
+
+# Source-channel ingest
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))  # Documents per transaction and summary reply
+INGEST_LINGER = float(os.getenv("INGEST_LINGER", "3"))  # Seconds to wait for a batch to fill
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))  # Queued documents before the handler blocks
+
+# Webhook mode (leave WEBHOOK_URL empty to long-poll)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # Public base URL, e.g. https://your-app.onrender.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Path and header secret; letters, digits, _ and - only
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Parallel deliveries Telegram may open
+
+# Concurrent update handling
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))  # Per-chat-ordered update lanes; 0 = one update at a time
+SEARCH_SESSION_TTL = int(os.getenv("SEARCH_SESSION_TTL", "3600"))  # Seconds a results message can still be paged
+SEARCH_SESSION_SIZE = int(os.getenv("SEARCH_SESSION_SIZE", "10000"))  # Results messages remembered for paging
+
+# Leases (one update consumer and one runner per background job across processes)
+LEASE_TTL = int(os.getenv("LEASE_TTL", "15"))  # Seconds a lease outlives its last heartbeat
+LEASE_RETRY_INTERVAL = float(os.getenv("LEASE_RETRY_INTERVAL", "2"))  # Seconds between takeover attempts
+
+# Readiness probe
+READY_MAX_DB_LATENCY = float(os.getenv("READY_MAX_DB_LATENCY", "0.5"))  # Seconds before /ready reports the DB as too slow
+
+# Profiling
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))  # Longest capture /profile or /debug/profile may run
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")  # Enables GET /debug/profile?token=... (capture runs in the background, read it from /debug/profile/report); empty = routes disabled
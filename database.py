@@ -1,20 +1,128 @@
 import sqlite3
 import os
+import math
+import random
+import threading
+import time
+from array import array
+from collections import Counter
 from contextlib import contextmanager
 from datetime import datetime
-from config import DATABASE
+from config import (
+    DATABASE, DB_BUSY_TIMEOUT, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, RESULTS_PER_PAGE,
+    SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, FUZZY_MIN_SIMILARITY, FUZZY_CANDIDATES,
+    FUZZY_MAX_POSTINGS, FUZZY_MAX_RESULTS, WRITE_FLUSH_INTERVAL, USER_FLUSH_MAX_PENDING, DOWNLOAD_FLUSH_MAX_PENDING,
+    SETTINGS_REFRESH_INTERVAL, RANDOM_POOL_TTL, RANDOM_POOL_MAX
+)
+from cache import TTLCache
+from metrics import DB_LATENCY
 import logging
 
 logger = logging.getLogger(__name__)
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+# Set by init_db once the trigram FTS5 index over files is available.
+FTS_ENABLED = False
+
+# Result pages keyed by (normalized query, page, per_page)
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+# ==================== Connection Manager ====================
+# Each thread keeps one read-write and one read-only connection open for its
+# lifetime instead of reconnecting on every call.
+
+_local = threading.local()
+_connections = {}  # (thread, readonly) -> connection, so they can be closed at shutdown
+_connections_lock = threading.Lock()
+_connections_generation = 0  # bumped by close_all_connections so every thread reconnects
+
+def _connect(readonly):
+    if readonly:
+        conn = sqlite3.connect(f"file:{DATABASE}?mode=ro", uri=True,
+                               timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+def _thread_connection(readonly):
+    attr = 'ro' if readonly else 'rw'
+    conn = getattr(_local, attr, None)
+    if conn is not None and _local.pid == os.getpid() and _local.generation == _connections_generation:
+        return conn
+    if getattr(_local, 'generation', None) != _connections_generation:
+        _local.ro = _local.rw = None  # closed by close_all_connections
+    conn = _connect(readonly)
+    setattr(_local, attr, conn)
+    _local.pid = os.getpid()
+    _local.generation = _connections_generation
+    thread = threading.current_thread()
+    with _connections_lock:
+        # Drop connections left behind by threads that have exited
+        for key in [k for k in _connections if not k[0].is_alive()]:
+            try:
+                _connections.pop(key).close()
+            except sqlite3.Error:
+                pass
+        _connections[(thread, readonly)] = conn
+    return conn
+
+@contextmanager
+def get_db(readonly=False):
+    """Yield this thread's connection; read-only callers get a separate query connection.
+
+    Anything left uncommitted is rolled back when the outermost block exits.
+    """
+    started = time.perf_counter()
+    conn = _thread_connection(readonly)
+    depth_attr = 'ro_depth' if readonly else 'rw_depth'
+    depth = getattr(_local, depth_attr, 0)
+    setattr(_local, depth_attr, depth + 1)
     try:
         yield conn
     finally:
-        conn.close()
+        setattr(_local, depth_attr, depth)
+        if depth == 0:
+            if conn.in_transaction:
+                conn.rollback()
+            DB_LATENCY.observe(time.perf_counter() - started, mode='ro' if readonly else 'rw')
+
+def close_all_connections():
+    """Close every pooled connection, e.g. before swapping databases; other threads reconnect."""
+    global _connections_generation
+    with _connections_lock:
+        _connections_generation += 1
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+    _local.__dict__.clear()
+    _close_settings_connection()
+
+def close_thread_connections():
+    """Close only the calling thread's connections (used at interpreter exit).
+
+    Daemon threads (update lanes, the flusher, broadcast and reaction workers)
+    may still be mid-query then; their connections are left for process exit
+    to release, and SQLite's journal keeps any unfinished write atomic.
+    """
+    thread = threading.current_thread()
+    with _connections_lock:
+        for readonly in (False, True):
+            conn = _connections.pop((thread, readonly), None)
+            if conn is not None:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+    _local.ro = _local.rw = None
 
 def init_db():
     with get_db() as conn:
@@ -44,6 +152,9 @@ def init_db():
         conn.execute("CREATE INDEX IF NOT EXISTS idx_normalized_name ON files(normalized_name);")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_author ON files(author);")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_category ON files(category);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_files_source ON files(channel_id, message_id);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_time ON files(upload_time DESC, id DESC);")
+        _init_search_index(conn)
 
         # Users table
         conn.execute("""
@@ -55,6 +166,9 @@ def init_db():
                 last_interaction TIMESTAMP
             )
         """)
+        # Set when a send fails because the user blocked the bot or was deleted
+        _add_column_if_missing(conn, "users", "blocked_at", "TIMESTAMP")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users(last_interaction);")
 
         # Settings table
         conn.execute("""
@@ -77,6 +191,7 @@ def init_db():
                 FOREIGN KEY(book_id) REFERENCES files(id) ON DELETE CASCADE
             )
         """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_book ON feedback(book_id);")
 
         # Downloads table
         conn.execute("""
@@ -111,8 +226,183 @@ def init_db():
             )
         """)
 
+        # Broadcast jobs; cursor is the last user_id already handled, so a job resumes after restarts
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT,
+                status TEXT DEFAULT 'running',
+                active_days INTEGER,
+                report_chat_id INTEGER,
+                cursor INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+
+        # Webhook updates received by a web worker that doesn't run the dispatcher
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Named leases (see leases.py); expires_at is a unix timestamp shared by every process
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                generation INTEGER NOT NULL DEFAULT 1
+            )
+        """)
+
+        _init_stats(conn)
+
         conn.commit()
 
+    # Warm the settings cache so the first messages don't pay for it
+    reload_settings()
+    _settings()
+
+def _add_column_if_missing(conn, table, column, decl):
+    columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _init_stats(conn):
+    """Counters and per-category totals kept current by triggers, so /stats and /categories never scan files."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS category_counts (
+            category TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_category_counts_count ON category_counts(count DESC);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_download_count ON files(download_count DESC);")
+
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_files_ai AFTER INSERT ON files BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'files';
+            INSERT INTO category_counts (category, count)
+            SELECT new.category, 1 WHERE new.category IS NOT NULL
+            ON CONFLICT(category) DO UPDATE SET count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_files_ad AFTER DELETE ON files BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'files';
+            UPDATE category_counts SET count = count - 1 WHERE category = old.category;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_files_au AFTER UPDATE OF category ON files BEGIN
+            UPDATE category_counts SET count = count - 1 WHERE category = old.category;
+            INSERT INTO category_counts (category, count)
+            SELECT new.category, 1 WHERE new.category IS NOT NULL
+            ON CONFLICT(category) DO UPDATE SET count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_users_ai AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_users_ad AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+        END
+    """)
+
+    if conn.execute("SELECT COUNT(*) FROM stats_counters").fetchone()[0] < 2:
+        _reconcile_stats(conn)
+
+def _reconcile_stats(conn):
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'files', COUNT(*) FROM files")
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    conn.execute("DELETE FROM category_counts")
+    conn.execute("""
+        INSERT INTO category_counts (category, count)
+        SELECT category, COUNT(*) FROM files WHERE category IS NOT NULL GROUP BY category
+    """)
+
+def reconcile_stats():
+    """Recount the materialized stats from the base tables, repairing any drift."""
+    with get_db() as conn:
+        _reconcile_stats(conn)
+        conn.commit()
+    logger.info("✅ Stats reconciled.")
+
+def _init_search_index(conn):
+    """Create the trigram FTS5 index over files, its sync triggers, and backfill it once."""
+    global FTS_ENABLED
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'"
+    ).fetchone()
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                normalized_name, original_filename, author,
+                content='files', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 trigram index unavailable, using LIKE search: {e}")
+        FTS_ENABLED = False
+        return
+
+    # Keep the index in sync with every write to files (add_file, imports, deletes)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_fts_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, normalized_name, original_filename, author)
+            VALUES (new.id, new.normalized_name, new.original_filename, new.author);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_fts_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, normalized_name, original_filename, author)
+            VALUES ('delete', old.id, old.normalized_name, old.original_filename, old.author);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_fts_au
+        AFTER UPDATE OF normalized_name, original_filename, author ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, normalized_name, original_filename, author)
+            VALUES ('delete', old.id, old.normalized_name, old.original_filename, old.author);
+            INSERT INTO files_fts (rowid, normalized_name, original_filename, author)
+            VALUES (new.id, new.normalized_name, new.original_filename, new.author);
+        END
+    """)
+
+    if not exists:
+        # One-time backfill for databases created before the index existed
+        conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+        logger.info("✅ Search index built for existing files.")
+    FTS_ENABLED = True
+
+def _search_filter(normalized):
+    """Return (where_clause, param) matching normalized_name as a substring.
+
+    The trigram index only answers queries of three or more characters;
+    shorter ones keep the plain LIKE scan.
+    """
+    if FTS_ENABLED and len(normalized) >= 3:
+        return ("id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)",
+                f'normalized_name : "{normalized}"')
+    return "normalized_name LIKE ?", f"%{normalized}%"
+
 def add_file(file_id, file_unique_id, original_filename, file_size, message_id, channel_id,
              author=None, category=None, language=None, year=None, pages=None):
     from utils import normalize_name
@@ -120,100 +410,618 @@ def add_file(file_id, file_unique_id, original_filename, file_size, message_id,
     normalized = normalize_name(name)
     with get_db() as conn:
         try:
-            conn.execute("""
+            cursor = conn.execute("""
                 INSERT INTO files (file_id, file_unique_id, normalized_name, original_filename,
                                    file_size, message_id, channel_id, author, category, language, year, pages)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (file_id, file_unique_id, normalized, original_filename, file_size,
                   message_id, channel_id, author, category, language, year, pages))
             conn.commit()
-            return True
         except sqlite3.IntegrityError:
             return False
+    # Exact pages change only for queries contained in the new name; fuzzy and
+    # empty pages (total 0 exact matches) may now pick it up, so drop those too
+    search_cache.invalidate(lambda key, value: value[2] or key[0] in normalized)
+    _add_to_random_pools([(cursor.lastrowid, category, language)])
+    return True
+
+def add_files(entries):
+    """Insert many files in one transaction; returns (added, duplicates).
 
-def search_files(query):
+    Each entry is a dict with add_file's arguments. Rows are skipped when their
+    file_id or file_unique_id is known, or when the same channel message is
+    already cataloged (e.g. once live and once from a history import).
+    """
     from utils import normalize_name
-    normalized_query = f"%{normalize_name(query)}%"
-    logger.info(f"🔍 search_files: query='{query}', normalized='{normalized_query}'")
+    rows = []
+    for entry in entries:
+        name, _ = os.path.splitext(entry['original_filename'])
+        rows.append((entry.get('file_id'), entry['file_unique_id'], normalize_name(name),
+                     entry['original_filename'], entry.get('file_size') or 0,
+                     entry.get('message_id'), entry.get('channel_id'), entry.get('author'),
+                     entry.get('category'), entry.get('language'), entry.get('year'),
+                     entry.get('pages'), entry.get('channel_id'), entry.get('message_id')))
+    if not rows:
+        return 0, 0
     with get_db() as conn:
-        rows = conn.execute("""
+        # Take the write lock first so ids above `newest` are exactly the rows inserted here
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        newest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+        cursor = conn.executemany("""
+            INSERT OR IGNORE INTO files (file_id, file_unique_id, normalized_name, original_filename,
+                                         file_size, message_id, channel_id, author, category,
+                                         language, year, pages)
+            SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM files WHERE channel_id = ? AND message_id = ?)
+        """, rows)
+        added = cursor.rowcount  # rows inserted by the statement itself, not by its triggers
+        inserted = conn.execute("SELECT id, category, language FROM files WHERE id > ?",
+                                (newest,)).fetchall() if added else []
+        conn.commit()
+    if added:
+        search_cache.clear()
+        _add_to_random_pools(inserted)
+    return added, len(rows) - added
+
+def search_files(query, limit=None, offset=0):
+    from utils import normalize_name
+    normalized_query = normalize_name(query)
+    logger.info(f"🔍 search_files: query='{query}', normalized='{normalized_query}'")
+    where, param = _search_filter(normalized_query)
+    with get_db(readonly=True) as conn:
+        rows = conn.execute(f"""
             SELECT id, original_filename, file_size, file_id, download_count,
                    author, category, language, year, pages, avg_rating, review_count
             FROM files
-            WHERE normalized_name LIKE ?
-            ORDER BY upload_time DESC
-        """, (normalized_query,)).fetchall()
+            WHERE {where}
+            ORDER BY upload_time DESC, id DESC
+            LIMIT ? OFFSET ?
+        """, (param, -1 if limit is None else limit, offset)).fetchall()
         logger.info(f"📊 search_files: found {len(rows)} rows")
         return [dict(row) for row in rows]
 
+def count_search_results(query):
+    from utils import normalize_name
+    where, param = _search_filter(normalize_name(query))
+    with get_db(readonly=True) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM files WHERE {where}", (param,)).fetchone()[0]
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _fuzzy_candidates(conn, grams):
+    """Ids of the titles sharing the most trigrams with the query, without ranking the whole index.
+
+    A title passing FUZZY_MIN_SIMILARITY holds at least `needed` of the query's
+    trigrams that occur in the index, so it contains one of the
+    (present - needed + 1) rarest ones. Those posting lists are read first and
+    define the candidates; commoner ones only add to their hit counts. Rarity
+    is estimated from capped probes and reads stop at FUZZY_MAX_POSTINGS rows,
+    newest first within each list, so the work doesn't grow with the catalog.
+    """
+    probe_cap = max(1, FUZZY_MAX_POSTINGS // len(grams))
+    newest = conn.execute("SELECT MAX(rowid) FROM files_fts").fetchone()[0] or 0
+    counts = {}
+    for gram in grams:
+        found, oldest = conn.execute(
+            "SELECT count(*), MIN(rowid) FROM (SELECT rowid FROM files_fts WHERE files_fts MATCH ? "
+            "ORDER BY rowid DESC LIMIT ?)",
+            (f'normalized_name : "{gram}"', probe_cap + 1)
+        ).fetchone()
+        # A full probe only saw the newest rows; extrapolate its density over the whole table
+        counts[gram] = found if found <= probe_cap else found * newest // (newest - oldest + 1)
+    present = sorted((g for g in grams if counts[g]), key=lambda g: (counts[g], g))
+    needed = math.ceil(FUZZY_MIN_SIMILARITY * len(grams))
+    if not present or len(present) < needed:
+        return []
+    required = len(present) - needed + 1
+    lists, params, budget = [], [], FUZZY_MAX_POSTINGS
+    for i, gram in enumerate(present):
+        # Past the rarest ones, only read lists that fit whole in what's left
+        if i >= required and counts[gram] > budget:
+            break
+        limit = max(budget, FUZZY_CANDIDATES)
+        lists.append("SELECT * FROM (SELECT rowid, ? AS required FROM files_fts "
+                     "WHERE files_fts MATCH ? ORDER BY rowid DESC LIMIT ?)")
+        params += [int(i < required), f'normalized_name : "{gram}"', limit]
+        budget -= min(counts[gram], limit)
+    return [row[0] for row in conn.execute(f"""
+        SELECT rowid FROM ({' UNION ALL '.join(lists)})
+        GROUP BY rowid HAVING MAX(required) = 1
+        ORDER BY COUNT(*) DESC, rowid DESC
+        LIMIT ?
+    """, params + [FUZZY_CANDIDATES]).fetchall()]
+
+def fuzzy_search_files(query, limit=FUZZY_MAX_RESULTS):
+    """Typo-tolerant search: rank titles by the share of the query's trigrams they contain.
+
+    Candidates come from _fuzzy_candidates, which reads a bounded number of
+    trigram postings, so only FUZZY_CANDIDATES rows are scored in Python.
+    """
+    from utils import normalize_name
+    normalized_query = normalize_name(query)
+    grams = _trigrams(normalized_query)
+    if not FTS_ENABLED or not grams:
+        return []
+    with get_db(readonly=True) as conn:
+        ids = _fuzzy_candidates(conn, grams)
+        if not ids:
+            return []
+        rows = conn.execute(f"""
+            SELECT id, normalized_name, original_filename, file_size, file_id, download_count,
+                   author, category, language, year, pages, avg_rating, review_count, upload_time
+            FROM files WHERE id IN ({','.join('?' * len(ids))})
+        """, ids).fetchall()
+
+    scored = []
+    for row in rows:
+        similarity = len(grams & _trigrams(row['normalized_name'] or '')) / len(grams)
+        if similarity >= FUZZY_MIN_SIMILARITY:
+            scored.append((similarity, row))
+    scored.sort(key=lambda item: (item[0], item[1]['upload_time'] or '', item[1]['id']), reverse=True)
+    logger.info(f"🧩 fuzzy_search_files: query='{query}', {len(scored)} of {len(rows)} candidates matched")
+    results = []
+    for _, row in scored[:limit]:
+        book = dict(row)
+        del book['normalized_name'], book['upload_time']
+        results.append(book)
+    return results
+
+def search_files_page(query, page=0, per_page=RESULTS_PER_PAGE):
+    """Return (results, total) for a single page of search results, served from search_cache when fresh.
+
+    Falls back to fuzzy_search_files when nothing matches exactly.
+    """
+    from utils import normalize_name
+    key = (normalize_name(query), page, per_page)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached[:2]
+    total = count_search_results(query)
+    if total == 0:
+        # Nothing matched exactly; fall back to typo-tolerant matches
+        matches = fuzzy_search_files(query)
+        result = (matches[page * per_page:(page + 1) * per_page], len(matches), True)
+    elif page * per_page >= total:
+        result = ([], total, False)
+    else:
+        result = (search_files(query, limit=per_page, offset=page * per_page), total, False)
+    search_cache.set(key, result)  # (rows, total, answered by the fuzzy fallback)
+    return result[:2]
+
+def invalidate_caches():
+    """Forget all cached data; call after the database contents are replaced."""
+    search_cache.clear()
+    with _random_lock:
+        _random_pools.clear()
+    reload_settings()
+
 def get_file_by_id(file_id):
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         row = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
     return dict(row) if row else None
 
+def ping_db():
+    """Run a trivial query against a real table; used by the readiness probe."""
+    with get_db(readonly=True) as conn:
+        conn.execute("SELECT value FROM stats_counters WHERE name = 'files'").fetchone()
+
+def _get_counter(name):
+    with get_db(readonly=True) as conn:
+        row = conn.execute("SELECT value FROM stats_counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
 def get_total_files():
-    with get_db() as conn:
-        return conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    return _get_counter('files')
 
 def get_total_users():
-    with get_db() as conn:
-        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    flush_pending_writes()
+    return _get_counter('users')
+
+def get_popular_categories(limit=10):
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("""
+            SELECT category, count FROM category_counts
+            WHERE count > 0
+            ORDER BY count DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+    return [dict(row) for row in rows]
 
 def get_db_size():
     return os.path.getsize(DATABASE) if os.path.exists(DATABASE) else 0
 
-def update_user(user_id, first_name, username):
+# ==================== Write-behind Buffers ====================
+# Hot-path writes are coalesced in memory and applied in one transaction by
+# a background thread every WRITE_FLUSH_INTERVAL seconds.
+
+_pending_users = {}      # user_id -> (first_name, username, last_interaction, reachable)
+_pending_downloads = []  # (user_id, book_id, downloaded_at)
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+_flusher_thread = None
+
+def _utc_now():
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')  # same format as CURRENT_TIMESTAMP
+
+def _flush_worker():
+    while True:
+        _flush_wakeup.wait(WRITE_FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        try:
+            flush_pending_writes()
+        except Exception as e:
+            logger.error(f"Background flush failed: {e}")
+
+def _ensure_flusher():
+    global _flusher_thread
+    if _flusher_thread is None or not _flusher_thread.is_alive():
+        with _pending_lock:
+            if _flusher_thread is None or not _flusher_thread.is_alive():
+                _flusher_thread = threading.Thread(target=_flush_worker, daemon=True, name="DBFlusher")
+                _flusher_thread.start()
+
+def _write_users(conn, users):
+    conn.executemany("""
+        INSERT INTO users (user_id, first_name, username, last_interaction)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            first_name = excluded.first_name,
+            username = excluded.username,
+            last_interaction = excluded.last_interaction
+    """, [(uid, first_name, username, seen) for uid, (first_name, username, seen, _) in users.items()])
+    # Seeing someone in a group says nothing about whether they still block the bot in private
+    reachable = [(uid,) for uid, entry in users.items() if entry[3]]
+    if reachable:
+        conn.executemany("UPDATE users SET blocked_at = NULL WHERE user_id = ?", reachable)
+
+def _write_downloads(conn, downloads):
+    counts = Counter(book_id for _, book_id, _ in downloads)
+    conn.executemany("UPDATE files SET download_count = download_count + ? WHERE id = ?",
+                     [(count, book_id) for book_id, count in counts.items()])
+    conn.executemany("INSERT INTO downloads (user_id, book_id, downloaded_at) VALUES (?, ?, ?)", downloads)
+
+def flush_pending_writes():
+    """Apply every buffered write in a single transaction. Safe to call from any thread."""
+    global _pending_users, _pending_downloads
+    with _flush_lock:
+        with _pending_lock:
+            users, _pending_users = _pending_users, {}
+            downloads, _pending_downloads = _pending_downloads, []
+        if not users and not downloads:
+            return
+        try:
+            with get_db() as conn:
+                if users:
+                    _write_users(conn, users)
+                if downloads:
+                    _write_downloads(conn, downloads)
+                conn.commit()
+        except sqlite3.Error:
+            # Put the batch back without clobbering anything buffered since
+            with _pending_lock:
+                for uid, entry in users.items():
+                    _pending_users.setdefault(uid, entry)
+                _pending_downloads[:0] = downloads
+            raise
+
+def update_user(user_id, first_name, username, reachable=False):
+    """Buffer a user upsert; it reaches the users table on the next flush.
+
+    reachable=True (a private-chat interaction) also clears a broadcast's blocked flag.
+    """
+    with _pending_lock:
+        previous = _pending_users.get(user_id)
+        reachable = reachable or bool(previous and previous[3])
+        _pending_users[user_id] = (first_name, username, _utc_now(), reachable)
+        pending = len(_pending_users)
+    _ensure_flusher()
+    if pending >= USER_FLUSH_MAX_PENDING:
+        _flush_wakeup.set()
+
+def get_all_users():
+    flush_pending_writes()
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("SELECT user_id FROM users").fetchall()
+    return [row[0] for row in rows]
+
+# ==================== Broadcast Jobs ====================
+
+def _audience_filter(active_days):
+    where = "blocked_at IS NULL"
+    params = []
+    if active_days:
+        where += " AND last_interaction >= datetime('now', ?)"
+        params.append(f"-{int(active_days)} days")
+    return where, params
+
+def create_broadcast_job(message, report_chat_id, active_days=None):
+    flush_pending_writes()
+    where, params = _audience_filter(active_days)
+    with get_db() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()[0]
+        cur = conn.execute("""
+            INSERT INTO broadcast_jobs (message, active_days, report_chat_id, total)
+            VALUES (?, ?, ?, ?)
+        """, (message, active_days, report_chat_id, total))
+        conn.commit()
+        return cur.lastrowid
+
+def get_broadcast_job(job_id):
+    with get_db(readonly=True) as conn:
+        row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_latest_broadcast_job():
+    with get_db(readonly=True) as conn:
+        row = conn.execute("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1").fetchone()
+    return dict(row) if row else None
+
+def get_running_broadcast_jobs():
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id").fetchall()
+    return [dict(row) for row in rows]
+
+def get_broadcast_recipients(job, limit):
+    """Next batch of recipient ids after the job's cursor, in user_id order."""
+    where, params = _audience_filter(job['active_days'])
+    with get_db(readonly=True) as conn:
+        rows = conn.execute(f"""
+            SELECT user_id FROM users
+            WHERE user_id > ? AND {where}
+            ORDER BY user_id
+            LIMIT ?
+        """, [job['cursor']] + params + [limit]).fetchall()
+    return [row[0] for row in rows]
+
+def save_broadcast_progress(job_id, cursor, sent, failed, blocked_ids):
+    """Advance a job past one finished batch and remember who blocked the bot."""
     with get_db() as conn:
+        if blocked_ids:
+            conn.executemany("UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                             [(uid,) for uid in blocked_ids])
         conn.execute("""
-            INSERT INTO users (user_id, first_name, username, last_interaction)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(user_id) DO UPDATE SET
-                first_name = excluded.first_name,
-                username = excluded.username,
-                last_interaction = CURRENT_TIMESTAMP
-        """, (user_id, first_name, username))
+            UPDATE broadcast_jobs
+            SET cursor = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+            WHERE id = ?
+        """, (cursor, sent, failed, len(blocked_ids), job_id))
         conn.commit()
 
-def get_all_users():
+def finish_broadcast_job(job_id, status):
     with get_db() as conn:
-        rows = conn.execute("SELECT user_id FROM users").fetchall()
-    return [row[0] for row in rows]
+        conn.execute("UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (status, job_id))
+        conn.commit()
 
-def is_bot_locked():
+# ==================== Webhook Inbox ====================
+
+def queue_webhook_update(payload):
     with get_db() as conn:
-        row = conn.execute("SELECT value FROM settings WHERE key = 'bot_locked'").fetchone()
-    return row and row[0] == 'true'
+        conn.execute("INSERT INTO webhook_inbox (payload) VALUES (?)", (payload,))
+        conn.commit()
+
+def pop_webhook_updates(limit=100):
+    """Remove and return up to limit queued update payloads, oldest first."""
+    with get_db() as conn:
+        rows = conn.execute("SELECT id, payload FROM webhook_inbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+        if rows:
+            conn.execute("DELETE FROM webhook_inbox WHERE id <= ?", (rows[-1]['id'],))
+            conn.commit()
+    return [row['payload'] for row in rows]
+
+# ==================== Leases ====================
+
+def try_acquire_lease(name, holder, ttl):
+    """Take or renew lease `name` for ttl seconds.
+
+    Returns the lease generation (bumped on every change of holder) if holder
+    now owns it, or None while another holder's lease is unexpired.
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                generation = generation + (holder != excluded.holder),
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        """, (name, holder, now + ttl, now))
+        row = conn.execute("SELECT holder, generation FROM leases WHERE name = ?", (name,)).fetchone()
+        conn.commit()
+    return row['generation'] if row['holder'] == holder else None
+
+def release_lease(name, holder):
+    with get_db() as conn:
+        conn.execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder))
+        conn.commit()
+
+def get_leases():
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("SELECT name, holder, expires_at, generation FROM leases ORDER BY name").fetchall()
+    return [dict(row) for row in rows]
+
+# ==================== Settings Cache ====================
+# The lock flag and banned users are checked on every group message, so they
+# are served from memory. Our own writes update the cache directly; writes
+# from other processes are noticed through PRAGMA data_version on a dedicated
+# connection, polled at most every SETTINGS_REFRESH_INTERVAL seconds.
+
+_settings_cache = {'loaded': False, 'bot_locked': False, 'banned': set(),
+                   'data_version': None, 'checked_at': 0.0}
+_settings_lock = threading.Lock()
+_settings_conn = None
+
+def _close_settings_connection():
+    global _settings_conn
+    with _settings_lock:
+        if _settings_conn is not None:
+            try:
+                _settings_conn.close()
+            except sqlite3.Error:
+                pass
+            _settings_conn = None
+        _settings_cache['loaded'] = False
+
+def _load_settings(conn):
+    locked = False
+    banned = set()
+    rows = conn.execute("""
+        SELECT key, value FROM settings
+        WHERE key = 'bot_locked' OR substr(key, 1, 7) = 'banned_'
+    """).fetchall()
+    for key, value in rows:
+        if key == 'bot_locked':
+            locked = value == 'true'
+        elif value == 'true':
+            try:
+                banned.add(int(key[7:]))
+            except ValueError:
+                pass
+    _settings_cache['bot_locked'] = locked
+    _settings_cache['banned'] = banned
+    _settings_cache['loaded'] = True
+
+def _settings():
+    """Return the settings cache, reloading it if another connection changed the database."""
+    now = time.monotonic()
+    if _settings_cache['loaded'] and now - _settings_cache['checked_at'] < SETTINGS_REFRESH_INTERVAL:
+        return _settings_cache
+    global _settings_conn
+    with _settings_lock:
+        if _settings_conn is None:
+            _settings_conn = _connect(readonly=True)
+        version = _settings_conn.execute("PRAGMA data_version").fetchone()[0]
+        if not _settings_cache['loaded'] or version != _settings_cache['data_version']:
+            _load_settings(_settings_conn)
+            _settings_cache['data_version'] = version
+        _settings_cache['checked_at'] = now
+    return _settings_cache
+
+def reload_settings():
+    """Force the next settings lookup to re-read the settings table."""
+    with _settings_lock:
+        _settings_cache['loaded'] = False
+
+def is_bot_locked():
+    return _settings()['bot_locked']
 
 def set_bot_locked(locked: bool):
     with get_db() as conn:
         conn.execute("UPDATE settings SET value = ? WHERE key = 'bot_locked'", ('true' if locked else 'false',))
         conn.commit()
+    with _settings_lock:
+        _settings_cache['bot_locked'] = locked
 
 def increment_download(book_id, user_id):
-    with get_db() as conn:
-        conn.execute("UPDATE files SET download_count = download_count + 1 WHERE id = ?", (book_id,))
-        conn.execute("INSERT INTO downloads (user_id, book_id) VALUES (?, ?)", (user_id, book_id))
-        conn.commit()
+    """Buffer a download; the counter and downloads row are written on the next flush."""
+    with _pending_lock:
+        _pending_downloads.append((user_id, book_id, _utc_now()))
+        pending = len(_pending_downloads)
+    _ensure_flusher()
+    if pending >= DOWNLOAD_FLUSH_MAX_PENDING:
+        _flush_wakeup.set()
 
 def get_top_books(limit=10):
-    with get_db() as conn:
+    with _pending_lock:
+        pending = Counter(book_id for _, book_id, _ in _pending_downloads)
+    with get_db(readonly=True) as conn:
         rows = conn.execute("""
             SELECT id, original_filename, file_size, download_count
             FROM files
             ORDER BY download_count DESC
             LIMIT ?
         """, (limit,)).fetchall()
-    return [dict(row) for row in rows]
+        books = {row['id']: dict(row) for row in rows}
+        # Books with unflushed downloads may overtake the stored top list
+        missing = [book_id for book_id in pending if book_id not in books]
+        if missing:
+            rows = conn.execute(f"""
+                SELECT id, original_filename, file_size, download_count
+                FROM files WHERE id IN ({','.join('?' * len(missing))})
+            """, missing).fetchall()
+            books.update((row['id'], dict(row)) for row in rows)
+    for book_id, count in pending.items():
+        if book_id in books:
+            books[book_id]['download_count'] += count
+    return sorted(books.values(), key=lambda b: b['download_count'], reverse=True)[:limit]
 
-def get_random_book():
-    with get_db() as conn:
-        row = conn.execute("""
-            SELECT id, original_filename, file_size, file_id
-            FROM files
-            ORDER BY RANDOM()
-            LIMIT 1
-        """).fetchone()
-    return dict(row) if row else None
+# ==================== Random Picks ====================
+# /random draws from in-memory arrays of file ids instead of sorting the whole
+# table with ORDER BY RANDOM(). Pools are keyed by (category, language), loaded
+# on first use, extended by add_file and reloaded after RANDOM_POOL_TTL.
+
+_random_pools = {}  # (category, language) -> (loaded_at, array of ids)
+_random_lock = threading.Lock()
+
+def _pool_key(category=None, language=None):
+    return ((category or '').strip().lower() or None, (language or '').strip().lower() or None)
+
+def _load_random_pool(key):
+    category, language = key
+    clauses, params = [], []
+    if category:
+        clauses.append("category = ? COLLATE NOCASE")
+        params.append(category)
+    if language:
+        clauses.append("language = ? COLLATE NOCASE")
+        params.append(language)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    with get_db(readonly=True) as conn:
+        return array('q', (row[0] for row in conn.execute(f"SELECT id FROM files{where}", params)))
+
+def _random_pool(key):
+    with _random_lock:
+        entry = _random_pools.get(key)
+        if entry and time.monotonic() - entry[0] < RANDOM_POOL_TTL:
+            return entry[1]
+    ids = _load_random_pool(key)
+    with _random_lock:
+        if key not in _random_pools and len(_random_pools) >= RANDOM_POOL_MAX:
+            oldest = min(_random_pools, key=lambda k: _random_pools[k][0])
+            del _random_pools[oldest]
+        _random_pools[key] = (time.monotonic(), ids)
+    return ids
+
+def _add_to_random_pools(books):
+    """Append newly inserted (id, category, language) rows to every loaded pool they belong in."""
+    with _random_lock:
+        if not _random_pools:
+            return
+        for book_id, category, language in books:
+            book_category, book_language = _pool_key(category, language)
+            for (pool_category, pool_language), (_, ids) in _random_pools.items():
+                if pool_category not in (None, book_category) or pool_language not in (None, book_language):
+                    continue
+                ids.append(book_id)
+
+def get_random_book(category=None, language=None, attempts=5):
+    """Pick a uniformly random book, optionally from one category and/or language."""
+    key = _pool_key(category, language)
+    ids = _random_pool(key)
+    for _ in range(attempts):
+        with _random_lock:
+            if not ids:
+                return None
+            index = random.randrange(len(ids))
+            book_id = ids[index]
+        with get_db(readonly=True) as conn:
+            row = conn.execute("""
+                SELECT id, original_filename, file_size, file_id
+                FROM files WHERE id = ?
+            """, (book_id,)).fetchone()
+        if row:
+            return dict(row)
+        # Deleted since the pool was loaded: swap-remove it so later picks stay uniform
+        with _random_lock:
+            if index < len(ids) and ids[index] == book_id:
+                ids[index] = ids[-1]
+                ids.pop()
+    with _random_lock:
+        _random_pools.pop(key, None)
+    return None
 
 def add_feedback(user_id, book_id, rating, comment=None):
     with get_db() as conn:
@@ -221,14 +1029,35 @@ def add_feedback(user_id, book_id, rating, comment=None):
             INSERT INTO feedback (user_id, book_id, rating, comment)
             VALUES (?, ?, ?, ?)
         """, (user_id, book_id, rating, comment))
-        # Update avg_rating
+        # Fold the new rating into the running average (SET sees the old values)
         conn.execute("""
             UPDATE files SET
-                avg_rating = (SELECT AVG(rating) FROM feedback WHERE book_id = ?),
-                review_count = (SELECT COUNT(*) FROM feedback WHERE book_id = ?)
+                avg_rating = (avg_rating * review_count + ?) / (review_count + 1),
+                review_count = review_count + 1
             WHERE id = ?
-        """, (book_id, book_id, book_id))
+        """, (rating, book_id))
+        conn.commit()
+
+def recompute_ratings():
+    """Rebuild avg_rating/review_count from the feedback table; returns how many books were off."""
+    with get_db() as conn:
+        before = conn.total_changes
+        conn.execute("""
+            UPDATE files SET avg_rating = 0, review_count = 0
+            WHERE review_count != 0 AND id NOT IN (SELECT book_id FROM feedback)
+        """)
+        conn.execute("""
+            UPDATE files SET avg_rating = agg.avg_rating, review_count = agg.review_count
+            FROM (
+                SELECT book_id, AVG(rating) AS avg_rating, COUNT(*) AS review_count
+                FROM feedback GROUP BY book_id
+            ) AS agg
+            WHERE files.id = agg.book_id
+              AND (files.review_count != agg.review_count
+                   OR abs(files.avg_rating - agg.avg_rating) > 1e-9)
+        """)
         conn.commit()
+        return conn.total_changes - before
 
 def warn_user(user_id, warned_by, reason):
     with get_db() as conn:
@@ -241,15 +1070,15 @@ def warn_user(user_id, warned_by, reason):
         return count
 
 def is_user_banned(user_id):
-    with get_db() as conn:
-        row = conn.execute("SELECT value FROM settings WHERE key = ?", (f"banned_{user_id}",)).fetchone()
-        return row is not None and row['value'] == 'true'
+    return user_id in _settings()['banned']
 
 def ban_user(user_id):
     with get_db() as conn:
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
                      (f"banned_{user_id}", "true"))
         conn.commit()
+    with _settings_lock:
+        _settings_cache['banned'].add(user_id)
 
 def bookmark(user_id, book_id):
     with get_db() as conn:
@@ -257,7 +1086,7 @@ def bookmark(user_id, book_id):
         conn.commit()
 
 def get_user_bookmarks(user_id):
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         rows = conn.execute("""
             SELECT f.id, f.original_filename, f.file_size
             FROM bookmarks b
@@ -272,11 +1101,39 @@ def vacuum_db():
         conn.execute("VACUUM")
     logger.info("✅ Database vacuumed.")
 
+def snapshot_db(dest_path):
+    """Write a consistent copy of the live database (including WAL contents) to dest_path."""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        with get_db(readonly=True) as conn:
+            conn.backup(dest)
+    finally:
+        dest.close()
+
+def restore_db(src_path):
+    """Replace the live database contents with src_path while connections stay open."""
+    src = sqlite3.connect(src_path)
+    try:
+        with get_db() as conn:
+            src.backup(conn)
+    finally:
+        src.close()
+    init_db()
+    reconcile_stats()
+    invalidate_caches()
+
 def backup_db(bot, chat_id):
+    snapshot = f"{DATABASE}.snapshot"
     try:
-        with open(DATABASE, 'rb') as f:
+        snapshot_db(snapshot)
+        with open(snapshot, 'rb') as f:
             bot.send_document(chat_id=chat_id, document=f, filename='bot_data_backup.db')
         return True
     except Exception as e:
         logger.error(f"Backup failed: {e}")
         return False
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
@@ -3,11 +3,18 @@ from .commands import get_handlers as get_command_handlers
 from .messages import group_message_handler_obj
 from .callbacks import callback_handler
 from .inline import inline_handler
+from metrics import instrument_handler
+
+def register_handlers(dispatcher):
+    """Add the bot's handlers to dispatcher, each timed for /metrics; earlier handlers win within a group."""
+    for handler in [source_group_handler_obj, *get_command_handlers(), group_message_handler_obj, callback_handler]:
+        dispatcher.add_handler(instrument_handler(handler))
 
 __all__ = [
     'source_group_handler_obj',
     'get_command_handlers',
     'group_message_handler_obj',
     'callback_handler',
-    'inline_handler'
+    'inline_handler',
+    'register_handlers'
 ]
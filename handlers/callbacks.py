@@ -1,8 +1,8 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 from telegram.ext import CallbackQueryHandler, CallbackContext
-from database import get_file_by_id, increment_download
+from database import get_file_by_id, increment_download, search_files_page
 from config import OWNER_ID, FORCE_SUB_CHANNEL, RESULTS_PER_PAGE, REQUEST_GROUP
-from utils import format_size, build_info_keyboard, format_book_caption, romantic_heart, decorative_header, decorative_footer, section_divider
+from utils import format_size, build_info_keyboard, format_book_caption, romantic_heart, decorative_header, decorative_footer, section_divider, search_sessions
 import logging
 
 logger = logging.getLogger(__name__)
@@ -30,13 +30,24 @@ def button_callback(update: Update, context: CallbackContext):
 
             # Send PDF with enhanced caption
             caption = f"📘 <b>{book['original_filename']}</b>\n{format_book_caption(book)}"
-            context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=book['file_id'],
-                caption=caption,
-                parse_mode=ParseMode.HTML,
-                reply_to_message_id=query.message.message_id
-            )
+            if book['file_id']:
+                context.bot.send_document(
+                    chat_id=query.message.chat_id,
+                    document=book['file_id'],
+                    caption=caption,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=query.message.message_id
+                )
+            else:
+                # Imported from channel history: no file_id, so copy the original post
+                context.bot.copy_message(
+                    chat_id=query.message.chat_id,
+                    from_chat_id=book['channel_id'],
+                    message_id=book['message_id'],
+                    caption=caption,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=query.message.message_id
+                )
 
             # Track download
             try:
@@ -55,18 +66,19 @@ def button_callback(update: Update, context: CallbackContext):
 
     elif data.startswith("page_"):
         page = int(data[5:])
-        context.user_data['current_page'] = page
-        results = context.user_data.get('search_results', [])
+        search_query = search_sessions.get((query.message.chat_id, query.message.message_id))
+        if not search_query:
+            query.edit_message_text(f"{romantic_heart()} This search has faded from my memory, my love. Please search again.")
+            return
+        results, total = search_files_page(search_query, page)
         if not results:
             query.edit_message_text(f"{romantic_heart()} No results found, my love.")
             return
-        total = len(results)
         start = page * RESULTS_PER_PAGE
-        end = min(start + RESULTS_PER_PAGE, total)
-        page_results = results[start:end]
+        end = start + len(results)
 
         keyboard = []
-        for res in page_results:
+        for res in results:
             btn_text = f"📘 {res['original_filename']} ({format_size(res['file_size'])})"
             keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"get_{res['id']}")])
 
@@ -1,22 +1,28 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ChatAction
-from telegram.ext import CommandHandler, Filters, CallbackContext, MessageHandler
-from config import OWNER_ID, BOT_NAME, FORCE_SUB_CHANNEL, REQUEST_GROUP, RESULTS_PER_PAGE
+from telegram.ext import CommandHandler, Filters, CallbackContext, MessageHandler, ChatMemberHandler
+from config import OWNER_ID, BOT_NAME, FORCE_SUB_CHANNEL, REQUEST_GROUP, RESULTS_PER_PAGE, PROFILE_MAX_SECONDS
 from database import (
     get_total_files, get_total_users, get_db_size, is_bot_locked,
-    set_bot_locked, get_all_users, update_user, search_files,
+    set_bot_locked, update_user, search_files_page,
     get_top_books, get_random_book, add_feedback, warn_user, is_user_banned,
-    bookmark, get_user_bookmarks, vacuum_db, backup_db, get_db
+    bookmark, get_user_bookmarks, vacuum_db, backup_db, get_db,
+    snapshot_db, restore_db, invalidate_caches, search_cache, get_latest_broadcast_job,
+    recompute_ratings, get_popular_categories
 )
+from broadcast import broadcast_engine
 from utils import (
     get_uptime, get_memory_usage, get_disk_usage, check_subscription,
     log_to_channel, build_start_keyboard, build_info_keyboard, format_size,
     safe_reply_text, format_book_caption, decorative_header, decorative_footer,
-    section_divider, star_line, cute_border, romantic_heart, fancy_bold
+    section_divider, star_line, cute_border, romantic_heart, fancy_bold,
+    subscription_cache, remember_subscription, is_force_sub_chat, update_admin_roster,
+    search_sessions
 )
 import datetime
+import io
 import logging
-import time
 import random
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -46,21 +52,18 @@ def owner_only(func):
         return func(update, context, *args, **kwargs)
     return wrapper
 
-def send_results_page(update: Update, context: CallbackContext, page):
-    """Shared function to display search results with pagination."""
+def send_results_page(update: Update, context: CallbackContext, page, results, total):
+    """Shared function to display one page of search results; `results` holds only that page."""
     from utils import build_info_keyboard, format_size
-    results = context.user_data.get('search_results', [])
     if not results:
         update.message.reply_text(f"{romantic_heart()} No results found, my dear. Try another name?")
         return
 
-    total = len(results)
     start = page * RESULTS_PER_PAGE
-    end = min(start + RESULTS_PER_PAGE, total)
-    page_results = results[start:end]
+    end = start + len(results)
 
     keyboard = []
-    for res in page_results:
+    for res in results:
         btn_text = f"📘 {res['original_filename']} ({format_size(res['file_size'])})"
         keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"get_{res['id']}")])
 
@@ -77,7 +80,7 @@ def send_results_page(update: Update, context: CallbackContext, page):
         keyboard.extend(info_buttons)
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(
+    return update.message.reply_text(
         f"{decorative_header('ꜰᴏᴜɴᴅ ꜱᴏᴍᴇᴛʜɪɴɢ')}\n\n"
         f"📚 For you, I found {fancy_bold(str(total))} treasures (page {page+1}/{(total+RESULTS_PER_PAGE-1)//RESULTS_PER_PAGE}):",
         reply_markup=reply_markup,
@@ -88,7 +91,7 @@ def send_results_page(update: Update, context: CallbackContext, page):
 
 def start(update: Update, context):
     user = update.effective_user
-    update_user(user.id, user.first_name, user.username)
+    update_user(user.id, user.first_name, user.username, reachable=update.effective_chat.type == "private")
 
     context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
@@ -153,7 +156,7 @@ def help_command(update: Update, context):
         "• <code>/help</code> – this sweet guide.\n"
         "• <code>/stats</code> – see how much we've grown together.\n"
         "• <code>/book &lt;name&gt;</code> – search my library for you.\n"
-        "• <code>/random</code> – a random book, just because.\n"
+        "• <code>/random [category]</code> – a random book, just because.\n"
         "• <code>/top</code> – the books everyone loves.\n"
         "• <code>/feedback &lt;id&gt; &lt;rating&gt; [comment]</code> – rate a book (1-5).\n"
         "• <code>#book &lt;name&gt;</code> – same as /book, darling.\n"
@@ -166,7 +169,8 @@ def help_command(update: Update, context):
         f"{section_divider()}\n\n"
         "<b>Owner's secrets (only for my master):</b>\n"
         "• <code>/users</code> – how many hearts I've touched.\n"
-        "• <code>/broadcast &lt;msg&gt;</code> – send a message to all.\n"
+        "• <code>/broadcast [--days=N] &lt;msg&gt;</code> – send a message to all (or to recent users).\n"
+        "• <code>/broadcast_status</code> / <code>/broadcast_cancel</code> – watch or stop a broadcast.\n"
         "• <code>/lock</code> / <code>/unlock</code> – lock or unlock me.\n"
         "• <code>/import</code> – import my database (reply to a .db file).\n"
         "• <code>/export</code> – export my soul.\n"
@@ -174,7 +178,12 @@ def help_command(update: Update, context):
         "• <code>/warn &lt;user_id&gt; &lt;reason&gt;</code> – warn a naughty user.\n"
         "• <code>/categories</code> – see popular categories.\n"
         "• <code>/backup</code> – manual database backup.\n"
-        "• <code>/vacuum</code> – clean my database.\n\n"
+        "• <code>/vacuum</code> – clean my database.\n"
+        "• <code>/fix_ratings</code> – recount every book's rating from its reviews.\n"
+        "• <code>/cachestats</code> – see how well my memory is serving.\n"
+        "• <code>/queues</code> – see what's waiting in my queues.\n"
+        "• <code>/memory</code> – see which of my parts use memory.\n"
+        "• <code>/profile [seconds]</code> – profile me and get the report as a file.\n\n"
         f"{star_line()}\n"
         "📖 <b>Books I hold:</b> Self-improvement, Hindi novels, English classics, etc.\n"
         "❌ <b>No pirated content.</b> I'm pure.\n\n"
@@ -216,22 +225,26 @@ def book_search(update: Update, context):
         update.message.reply_text(f"{romantic_heart()} Tell me what you're looking for, sweetheart. Example: /book mindset")
         return
     query = ' '.join(context.args)
-    results = search_files(query)
+    results, total = search_files_page(query, 0)
     if not results:
         update.message.reply_text(f"{romantic_heart()} I couldn't find any book with that name, my love. Try another?")
         return
-    context.user_data['search_results'] = results
-    context.user_data['current_page'] = 0
     try:
-        send_results_page(update, context, 0)
+        sent = send_results_page(update, context, 0, results, total)
+        if sent:
+            search_sessions.set((sent.chat_id, sent.message_id), query)
     except Exception as e:
         logger.error(f"Error in book_search send_results_page: {e}", exc_info=True)
         update.message.reply_text(f"{romantic_heart()} Something went wrong while I was trying to show you the results. Forgive me.")
 
 def random_book(update: Update, context):
-    book = get_random_book()
+    category = " ".join(context.args) if context.args else None
+    book = get_random_book(category=category)
     if not book:
-        update.message.reply_text(f"{romantic_heart()} I have no books yet, darling. Wait a bit.")
+        if category:
+            update.message.reply_text(f"{romantic_heart()} I have no {category} books yet, darling. Try /categories.")
+        else:
+            update.message.reply_text(f"{romantic_heart()} I have no books yet, darling. Wait a bit.")
         return
     keyboard = [[InlineKeyboardButton(f"📘 {book['original_filename']} ({format_size(book['file_size'])})", callback_data=f"get_{book['id']}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -347,15 +360,7 @@ def my_books(update: Update, context):
     )
 
 def popular_categories(update: Update, context):
-    with get_db() as conn:
-        rows = conn.execute("""
-            SELECT category, COUNT(*) as count
-            FROM files
-            WHERE category IS NOT NULL
-            GROUP BY category
-            ORDER BY count DESC
-            LIMIT 10
-        """).fetchall()
+    rows = get_popular_categories(10)
     if not rows:
         update.message.reply_text(f"{romantic_heart()} No categories yet, my sweet.")
         return
@@ -374,21 +379,58 @@ def users(update: Update, context):
 
 @owner_only
 def broadcast(update: Update, context):
-    if not context.args:
-        update.message.reply_text("📢 Usage: /broadcast <message>", parse_mode=ParseMode.HTML)
-        return
-    message = ' '.join(context.args)
-    users = get_all_users()
-    success = 0
-    for uid in users:
+    args = list(context.args)
+    active_days = None
+    if args and args[0].startswith('--days='):
         try:
-            context.bot.send_message(uid, message)
-            success += 1
-            time.sleep(0.05)
-        except Exception as e:
-            logger.error(f"Broadcast to {uid} failed: {e}")
-    update.message.reply_text(f"📢 Broadcast sent to {success}/{len(users)} hearts.")
-    log_to_channel(context.bot, f"Broadcast sent by owner: {message[:50]}...")
+            active_days = int(args.pop(0)[7:])
+        except ValueError:
+            active_days = None
+    if not args:
+        update.message.reply_text("📢 Usage: /broadcast [--days=N] <message>")
+        return
+    message = ' '.join(args)
+    job_id = broadcast_engine.start_job(context.bot, message, update.effective_chat.id, active_days)
+    job = broadcast_engine.progress(job_id)
+    audience = f" active in the last {active_days} days" if active_days else ""
+    update.message.reply_text(
+        f"📢 Broadcast #{job_id} started to {job['total']} hearts{audience}.\n"
+        f"Use /broadcast_status to watch it, or /broadcast_cancel to stop it."
+    )
+    log_to_channel(context.bot, f"Broadcast #{job_id} started by owner: {message[:50]}...")
+
+@owner_only
+def broadcast_status(update: Update, context):
+    job_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    if job_id is None:
+        latest = get_latest_broadcast_job()
+        job_id = latest['id'] if latest else None
+    job = broadcast_engine.progress(job_id) if job_id else None
+    if not job:
+        update.message.reply_text("📢 No broadcasts yet, master.")
+        return
+    percent = job['done'] / job['total'] * 100 if job['total'] else 100
+    text = (
+        f"📢 <b>Broadcast #{job['id']}</b> – {job['status']}\n\n"
+        f"✅ Sent: {job['sent']}\n"
+        f"🚫 Blocked: {job['blocked']}\n"
+        f"❌ Failed: {job['failed']}\n"
+        f"📊 Progress: {job['done']}/{job['total']} ({percent:.1f}%)\n"
+    )
+    if job['status'] == 'running' and job['rate']:
+        text += f"⚡ Throughput: {job['rate']:.1f}/s\n⏳ ETA: {datetime.timedelta(seconds=int(job['eta']))}\n"
+    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+@owner_only
+def broadcast_cancel(update: Update, context):
+    job_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    if job_id is None:
+        latest = get_latest_broadcast_job()
+        job_id = latest['id'] if latest else None
+    if job_id and broadcast_engine.cancel(job_id):
+        update.message.reply_text(f"📢 Broadcast #{job_id} will stop after the current batch, master.")
+    else:
+        update.message.reply_text("📢 No running broadcast to cancel, master.")
 
 @owner_only
 def lock(update: Update, context):
@@ -418,9 +460,8 @@ def import_db(update: Update, context):
     new_file.download('imported.db')
 
     import os
-    import shutil
     try:
-        shutil.copy2('imported.db', 'bot_data.db')
+        restore_db('imported.db')
         os.remove('imported.db')
         update.message.reply_text("✅ Database imported successfully, master!")
         log_to_channel(context.bot, "Database imported by owner.")
@@ -429,11 +470,16 @@ def import_db(update: Update, context):
 
 @owner_only
 def export_db(update: Update, context):
+    import os
     try:
-        with open('bot_data.db', 'rb') as f:
+        snapshot_db('exported.db')
+        with open('exported.db', 'rb') as f:
             update.message.reply_document(document=f, filename='bot_data.db')
     except Exception as e:
         update.message.reply_text(f"❌ Export failed: {e}")
+    finally:
+        if os.path.exists('exported.db'):
+            os.remove('exported.db')
 
 @owner_only
 def delete_db(update: Update, context):
@@ -446,6 +492,7 @@ def confirm_delete(update: Update, context):
         from database import get_db, init_db
         with get_db() as conn:
             conn.execute("DROP TABLE IF EXISTS files")
+            conn.execute("DROP TABLE IF EXISTS files_fts")
             conn.execute("DROP TABLE IF EXISTS users")
             conn.execute("DROP TABLE IF EXISTS settings")
             conn.execute("DROP TABLE IF EXISTS categories")
@@ -456,7 +503,11 @@ def confirm_delete(update: Update, context):
             conn.execute("DROP TABLE IF EXISTS user_badges")
             conn.execute("DROP TABLE IF EXISTS reading_challenges")
             conn.execute("DROP TABLE IF EXISTS bookmarks")
+            conn.execute("DROP TABLE IF EXISTS broadcast_jobs")
+            conn.execute("DROP TABLE IF EXISTS stats_counters")
+            conn.execute("DROP TABLE IF EXISTS category_counts")
         init_db()
+        invalidate_caches()
         update.message.reply_text("✅ All memories erased, master.")
         log_to_channel(context.bot, "Database deleted by owner.")
         context.user_data['confirm_delete'] = False
@@ -496,9 +547,89 @@ def vacuum(update: Update, context):
     vacuum_db()
     update.message.reply_text(f"{romantic_heart()} Database vacuumed, master.")
 
+@owner_only
+def fix_ratings(update: Update, context):
+    fixed = recompute_ratings()
+    update.message.reply_text(f"⭐ Ratings re-aggregated, master. {fixed} books were corrected.")
+
+@owner_only
+def cache_stats(update: Update, context):
+    search = search_cache.stats()
+    subs = subscription_cache.stats()
+    text = (
+        f"🗂️ <b>Cache stats, master</b>\n\n"
+        f"🔍 <b>Search:</b> {search['size']}/{search['maxsize']} entries, "
+        f"{search['hits']} hits, {search['misses']} misses ({search['hit_rate']:.0%} hit rate)\n"
+        f"🔔 <b>Subscriptions:</b> {subs['size']}/{subs['maxsize']} users, "
+        f"{subs['hits']} API calls saved, {subs['misses']} lookups ({subs['hit_rate']:.0%} hit rate)\n"
+    )
+    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+@owner_only
+def queues(update: Update, context):
+    from reactions import reaction_dispatcher
+    from ratelimit import rate_governor
+    from ingest import ingest_pipeline
+    r = reaction_dispatcher.stats()
+    g = rate_governor.stats()
+    i = ingest_pipeline.stats()
+    u = context.dispatcher.stats() if hasattr(context.dispatcher, 'stats') else None
+    text = (
+        f"📬 <b>Queues, master</b>\n\n"
+        f"⚡ <b>Reactions:</b> {r['queue_depth']}/{r['queue_size']} queued, {r['workers']} workers\n"
+        f"   sent {r['sent']}, failed {r['failed']}, "
+        f"dropped {r['dropped_full']} (full) / {r['dropped_stale']} (stale)\n"
+        f"   latency p50 {r['latency_p50']:.2f}s, p95 {r['latency_p95']:.2f}s\n"
+        f"🚦 <b>Bot API:</b> {g['calls']} calls, {g['throttled']} paced ({g['waited_seconds']:.1f}s), "
+        f"{g['retry_after']} flood waits, backoff {g['backoff_remaining']:.0f}s left\n"
+        f"📥 <b>Ingest:</b> {i['queue_depth']} queued, {i['per_minute']}/min, "
+        f"lag p50 {i['lag_p50']:.1f}s, p95 {i['lag_p95']:.1f}s\n"
+        f"   {i['saved']} saved, {i['duplicates']} duplicates, {i['too_large']} too large, "
+        f"{i['failed']} failed in {i['batches']} batches\n"
+    )
+    if u:
+        text += (
+            f"🛤️ <b>Updates:</b> {u['queued']} queued over {u['lanes']} lanes (busiest {u['busiest_lane']}), "
+            f"{u['processed']} handled, latency p50 {u['latency_p50']:.2f}s, p95 {u['latency_p95']:.2f}s\n"
+        )
+    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+@owner_only
+def memory(update: Update, context):
+    from profiling import memory_breakdown, format_memory_breakdown
+    lines = format_memory_breakdown(memory_breakdown())
+    update.message.reply_text("🧠 Memory, master\n\n" + "\n".join(lines))
+
+@owner_only
+def profile(update: Update, context):
+    from profiling import capture_profile
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        update.message.reply_text("Usage: /profile [seconds]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    message = update.message
+
+    def run():
+        # Off the update lane, so the capture doesn't stall the chats that share it
+        report = capture_profile(seconds)
+        if report is None:
+            message.reply_text("⏳ A profile is already being captured, master.")
+            return
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        message.reply_document(document=io.BytesIO(report.encode()), filename=f"profile-{stamp}.txt",
+                               caption=f"🔬 {seconds}s profile, master.")
+
+    message.reply_text(f"🔬 Profiling for {seconds}s, master...")
+    threading.Thread(target=run, daemon=True, name="Profiler").start()
+
 # ==================== Group Welcome Handler ====================
 
 def new_chat_members(update: Update, context):
+    if is_force_sub_chat(update.effective_chat):
+        for member in update.message.new_chat_members:
+            remember_subscription(member.id, True)
     for member in update.message.new_chat_members:
         if member.id == context.bot.id:
             update.message.reply_text(
@@ -515,6 +646,14 @@ def new_chat_members(update: Update, context):
             )
             break
 
+def chat_member_update(update: Update, context):
+    """Keep the subscription cache and admin rosters current from member status changes."""
+    change = update.chat_member
+    member = change.new_chat_member
+    update_admin_roster(change.chat.id, member.user.id, member.status in ['administrator', 'creator'])
+    if is_force_sub_chat(change.chat):
+        remember_subscription(member.user.id, member.status in ['member', 'administrator', 'creator'])
+
 # ==================== Handler Registration ====================
 
 def get_handlers():
@@ -524,6 +663,8 @@ def get_handlers():
         CommandHandler("stats", stats, Filters.chat_type.groups),
         CommandHandler("users", users, Filters.chat_type.groups),
         CommandHandler("broadcast", broadcast, Filters.chat_type.groups),
+        CommandHandler("broadcast_status", broadcast_status, Filters.chat_type.groups),
+        CommandHandler("broadcast_cancel", broadcast_cancel, Filters.chat_type.groups),
         CommandHandler("lock", lock, Filters.chat_type.groups),
         CommandHandler("unlock", unlock, Filters.chat_type.groups),
         CommandHandler("import", import_db, Filters.chat_type.groups),
@@ -541,5 +682,11 @@ def get_handlers():
         CommandHandler("categories", popular_categories, Filters.chat_type.groups),
         CommandHandler("backup", backup, Filters.chat_type.groups),
         CommandHandler("vacuum", vacuum, Filters.chat_type.groups),
+        CommandHandler("fix_ratings", fix_ratings, Filters.chat_type.groups),
+        CommandHandler("cachestats", cache_stats, Filters.chat_type.groups),
+        CommandHandler("queues", queues, Filters.chat_type.groups),
+        CommandHandler("memory", memory, Filters.chat_type.groups),
+        CommandHandler("profile", profile, Filters.chat_type.groups),
         MessageHandler(Filters.status_update.new_chat_members, new_chat_members),
+        ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER),
     ]
@@ -1,6 +1,6 @@
 from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
 from telegram.ext import InlineQueryHandler, CallbackContext
-from database import search_files
+from database import search_files_page
 from utils import format_size, romantic_heart
 import logging
 
@@ -11,7 +11,7 @@ def inline_query(update: Update, context: CallbackContext):
     if not query:
         return
 
-    results = search_files(query)[:50]  # Max 50 results
+    results, _ = search_files_page(query, 0, 50)  # Max 50 results
     inline_results = []
     for book in results:
         caption = f"📘 {book['original_filename']}\n📦 {format_size(book['file_size'])}"
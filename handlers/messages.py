@@ -1,50 +1,19 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ChatAction
 from telegram.ext import MessageHandler, Filters, CallbackContext
-from database import search_files, update_user, is_bot_locked, is_user_banned
+from database import search_files_page, update_user, is_bot_locked, is_user_banned
 from utils import (
     format_size, check_subscription, log_to_channel, build_info_keyboard,
-    send_reaction, safe_reply_text, romantic_heart, decorative_header,
-    decorative_footer, section_divider, star_line
+    safe_reply_text, romantic_heart, decorative_header,
+    decorative_footer, section_divider, star_line, is_chat_admin, search_sessions
 )
-from config import RESULTS_PER_PAGE, FORCE_SUB_CHANNEL, OWNER_ID, REACTION_DELAY
+from config import RESULTS_PER_PAGE, FORCE_SUB_CHANNEL, OWNER_ID
+from reactions import reaction_dispatcher
 import logging
-import queue
-import threading
-import time
-import random
 import re
 
 logger = logging.getLogger(__name__)
 
-reaction_queue = queue.Queue()
-reaction_running = True
-
-def reaction_worker():
-    while reaction_running:
-        try:
-            chat_id, message_id, msg_type = reaction_queue.get(timeout=1)
-            emoji_pools = {
-                "text": ["👍", "❤️", "🔥", "🥰", "👏", "😁", "🤔", "🤯", "😱", "🎉", "🤩", "🙏", "👌", "🕊️", "🤝", "😍", "😘", "💯", "💪", "🍓"],
-                "photo": ["❤️", "🔥", "👍", "👏", "😍", "🤩", "✨", "🌟", "🎯", "🏆"],
-                "video": ["🔥", "🎬", "👍", "👏", "😎", "💯", "⚡", "🚀", "🎉", "🏅"],
-                "sticker": ["😄", "😂", "🤣", "😍", "😎", "🤩", "🎭", "✨", "👍", "👌"],
-                "document": ["📄", "📚", "📖", "🔖", "📌", "✅", "👍", "❤️", "🔥", "🎉"]
-            }
-            emojis = emoji_pools.get(msg_type, emoji_pools["text"])
-            num_reactions = random.randint(1, 2)
-            for i in range(num_reactions):
-                emoji = random.choice(emojis)
-                is_big = (i == 0) and random.choice([True, False])
-                send_reaction(chat_id, message_id, emoji, is_big)
-                time.sleep(REACTION_DELAY)
-            reaction_queue.task_done()
-        except queue.Empty:
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Reaction worker error: {e}")
-
-reaction_thread = threading.Thread(target=reaction_worker, daemon=True)
-reaction_thread.start()
+reaction_dispatcher.start()
 
 def delete_message(context: CallbackContext):
     job = context.job
@@ -55,11 +24,7 @@ def delete_message(context: CallbackContext):
         logger.error(f"Auto-delete failed: {e}")
 
 def is_admin(update: Update, context, user_id):
-    try:
-        member = context.bot.get_chat_member(update.effective_chat.id, user_id)
-        return member.status in ['administrator', 'creator']
-    except:
-        return False
+    return is_chat_admin(context.bot, update.effective_chat.id, user_id)
 
 def group_message_handler(update: Update, context: CallbackContext):
     context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
@@ -75,7 +40,7 @@ def group_message_handler(update: Update, context: CallbackContext):
         msg_type = "sticker"
     elif update.message.document:
         msg_type = "document"
-    reaction_queue.put((chat_id, message_id, msg_type))
+    reaction_dispatcher.submit(chat_id, message_id, msg_type)
 
     user = update.effective_user
     if not user:
@@ -149,34 +114,32 @@ def group_message_handler(update: Update, context: CallbackContext):
             update.message.reply_text(f"{romantic_heart()} Please provide a book name after #book or /book.")
             return
 
-        results = search_files(query)
+        results, total = search_files_page(query, 0)
         if not results:
             safe_reply_text(update.message, f"{romantic_heart()} No books found matching your query.")
             log_to_channel(context.bot, f"Search '{query}' by {user.first_name} – no results")
             return
 
-        context.user_data['search_results'] = results
-        context.user_data['current_page'] = 0
         try:
-            send_results_page(update, context, 0)
+            sent = send_results_page(update, context, 0, results, total)
+            if sent:
+                search_sessions.set((sent.chat_id, sent.message_id), query)
         except Exception as e:
             logger.error(f"Error in send_results_page: {e}", exc_info=True)
             update.message.reply_text(f"{romantic_heart()} An error occurred while displaying results.")
 
-def send_results_page(update: Update, context: CallbackContext, page):
+def send_results_page(update: Update, context: CallbackContext, page, results, total):
+    """Reply with one page of results; `results` holds only that page's rows. Returns the sent message."""
     from utils import build_info_keyboard, format_size
-    results = context.user_data.get('search_results', [])
     if not results:
         update.message.reply_text(f"{romantic_heart()} No results found.")
         return
 
-    total = len(results)
     start = page * RESULTS_PER_PAGE
-    end = min(start + RESULTS_PER_PAGE, total)
-    page_results = results[start:end]
+    end = start + len(results)
 
     keyboard = []
-    for res in page_results:
+    for res in results:
         btn_text = f"📘 {res['original_filename']} ({format_size(res['file_size'])})"
         keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"get_{res['id']}")])
 
@@ -193,7 +156,7 @@ def send_results_page(update: Update, context: CallbackContext, page):
         keyboard.extend(info_buttons)
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(
+    return update.message.reply_text(
         f"{decorative_header('ꜰ ᴏ ᴜ ɴ ᴅ  ꜱ ᴏ ᴍ ᴇᴛ ʜ ɪ ɴ ɢ')}\n\n"
         f"📚 Found <b>{total}</b> treasures (page {page+1}/{(total+RESULTS_PER_PAGE-1)//RESULTS_PER_PAGE}):",
         reply_markup=reply_markup,
@@ -1,8 +1,7 @@
 from telegram.ext import MessageHandler, Filters
-from telegram import Update, ParseMode
-from config import SOURCE_CHANNELS, MAX_FILE_SIZE, LOG_CHANNEL
-from database import add_file
-from utils import log_to_channel, format_size, safe_reply_text
+from telegram import Update
+from config import SOURCE_CHANNELS, LOG_CHANNEL
+from ingest import ingest_pipeline
 import logging
 import traceback
 
@@ -25,35 +24,9 @@ def source_group_handler(update: Update, context):
         doc = message.document
         logger.info(f"📄 Document received: {doc.file_name} ({doc.file_size} bytes)")
 
-        if doc.file_size > MAX_FILE_SIZE:
-            logger.warning(f"File too large: {format_size(doc.file_size)} > {format_size(MAX_FILE_SIZE)}")
-            log_to_channel(context.bot, f"🚫 Ignored large file: {doc.file_name} ({format_size(doc.file_size)})")
-            return
-
-        added = add_file(
-            file_id=doc.file_id,
-            file_unique_id=doc.file_unique_id,
-            original_filename=doc.file_name,
-            file_size=doc.file_size,
-            message_id=message.message_id,
-            channel_id=chat_id
-        )
-
-        if added:
-            logger.info(f"✅ File added to database: {doc.file_name}")
-            safe_reply_text(
-                message,
-                f"✅ **PDF Saved Successfully!**\n📄 `{doc.file_name}`\n📦 Size: {format_size(doc.file_size)}",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            log_to_channel(context.bot, f"📚 New PDF added: {doc.file_name}\nSize: {format_size(doc.file_size)}")
-        else:
-            logger.info(f"⚠️ Duplicate file: {doc.file_name}")
-            safe_reply_text(
-                message,
-                "⚠️ This PDF is already in the database.",
-                parse_mode=ParseMode.MARKDOWN
-            )
+        # Saved in batches: one transaction, one reply and one log entry per batch
+        ingest_pipeline.start(context.bot)
+        ingest_pipeline.submit(message, chat_id)
 
     except Exception as e:
         logger.error(f"❌ Error in source_group_handler: {e}\n{traceback.format_exc()}")
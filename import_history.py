@@ -0,0 +1,172 @@
+"""Backfill a source channel's history into the catalog.
+
+Reads a Telegram Desktop export (result.json) or a JSON-lines file with one
+message per line, streaming it so memory stays flat however long the history:
+
+    python import_history.py result.json
+    python import_history.py messages.jsonl --channel-id -1001234567890
+
+Exported messages carry no Bot API file_id, so those books are stored with a
+synthetic file_unique_id ("hist:<channel>:<message>") and delivered by copying
+the original channel message.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from config import MAX_FILE_SIZE
+from database import init_db, add_files
+from utils import format_size
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+logger = logging.getLogger("import_history")
+
+CHUNK_SIZE = 1 << 20  # characters read from the export at a time
+# Exported media that is not a plain document
+NON_DOCUMENT_MEDIA = {"sticker", "animation", "video_file", "video_message", "voice_message", "audio_file"}
+# "file" holds this note instead of a path when the export was made without files
+FILE_NOT_INCLUDED = "(File not included"
+
+def _bot_api_chat_id(export_id):
+    """Telegram Desktop exports channel/supergroup ids without the -100 prefix."""
+    return export_id if export_id < 0 else int(f"-100{export_id}")
+
+def iter_export_messages(path):
+    """Yield (channel_id, message) from a result.json without loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buf = f.read(CHUNK_SIZE)
+        while True:
+            key = buf.find('"messages"')
+            start = buf.find('[', key) if key != -1 else -1
+            if start != -1:
+                break
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise ValueError(f"{path} has no messages array; is it a single-chat export?")
+            buf += chunk
+
+        match = re.search(r'"id"\s*:\s*(-?\d+)', buf[:key])
+        channel_id = _bot_api_chat_id(int(match.group(1))) if match else None
+        buf, pos = buf[start + 1:], 0
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf) or buf[pos] != ']':
+                try:
+                    message, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # The next message straddles the chunk boundary
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        if pos == len(buf):
+                            return
+                        raise
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+                yield channel_id, message
+                if pos > CHUNK_SIZE:
+                    buf, pos = buf[pos:], 0
+            else:
+                return
+
+def iter_jsonl_messages(path):
+    """Yield (channel_id, message) from a file with one JSON message per line."""
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"⚠️ Skipping line {line_no}: {e}")
+                continue
+            yield message.get('channel_id'), message
+
+def history_entry(message, channel_id):
+    """Turn one exported message into an add_files entry, or None if it holds no book."""
+    if message.get('type', 'message') != 'message' or message.get('media_type') in NON_DOCUMENT_MEDIA:
+        return None
+    file_path = message.get('file') or ''
+    if file_path.startswith(FILE_NOT_INCLUDED):
+        file_path = ''
+    file_name = message.get('file_name') or os.path.basename(file_path)
+    if not file_name:
+        return None
+    file_size = message.get('file_size') or 0
+    if file_size > MAX_FILE_SIZE:
+        return None
+    message_id = message.get('message_id') or message.get('id')
+    return {
+        'file_id': message.get('file_id') or None,
+        'file_unique_id': message.get('file_unique_id') or f"hist:{channel_id}:{message_id}",
+        'original_filename': file_name,
+        'file_size': file_size,
+        'message_id': message_id,
+        'channel_id': channel_id,
+    }
+
+def import_history(path, channel_id=None, batch_size=5000, fmt=None):
+    """Stream path into the catalog in batches of batch_size; returns the counters."""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'json')
+    messages = iter_jsonl_messages(path) if fmt == 'jsonl' else iter_export_messages(path)
+    stats = Counter()
+    batch = []
+    started = time.monotonic()
+
+    def flush():
+        added, duplicates = add_files(batch)
+        stats['added'] += added
+        stats['duplicates'] += duplicates
+        batch.clear()
+        elapsed = time.monotonic() - started
+        logger.info(f"📥 {stats['read']} messages read, {stats['added']} added, "
+                    f"{stats['duplicates']} duplicates ({stats['read'] / elapsed:.0f} msg/s)")
+
+    for source_channel, message in messages:
+        stats['read'] += 1
+        chat_id = channel_id or source_channel
+        if chat_id is None:
+            raise ValueError("Cannot tell which channel this history belongs to; pass --channel-id.")
+        entry = history_entry(message, chat_id)
+        if entry is None:
+            stats['skipped'] += 1
+            continue
+        stats['bytes'] += entry['file_size']
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    stats['seconds'] = time.monotonic() - started
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a channel's history export into the book catalog.")
+    parser.add_argument("path", help="result.json from Telegram Desktop, or a .jsonl file")
+    parser.add_argument("--channel-id", type=int, help="Bot API id of the source channel (default: read from the export)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows inserted per transaction")
+    parser.add_argument("--format", choices=("json", "jsonl"), help="input format (default: by file extension)")
+    args = parser.parse_args(argv)
+
+    init_db()
+    stats = import_history(args.path, args.channel_id, args.batch_size, args.format)
+    rate = stats['read'] / stats['seconds'] if stats['seconds'] else 0
+    logger.info(f"✅ Import finished in {stats['seconds']:.1f}s: {stats['read']} messages, "
+                f"{format_size(stats['bytes'])} of documents, {stats['added']} books added, "
+                f"{stats['duplicates']} duplicates, {stats['skipped']} skipped, {rate:.0f} msg/s")
+
+if __name__ == "__main__":
+    main()
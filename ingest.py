@@ -0,0 +1,157 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from config import MAX_FILE_SIZE, INGEST_BATCH_SIZE, INGEST_LINGER, INGEST_QUEUE_SIZE
+from database import add_files
+from utils import safe_send_message, log_to_channel, format_size
+
+logger = logging.getLogger(__name__)
+
+class IngestPipeline:
+    """Catalogs source-channel documents in batches instead of one by one.
+
+    The handler only queues each document. A worker thread collects up to
+    batch_size of them (waiting at most `linger` seconds for a batch to fill),
+    inserts each chat's share in one transaction, and sends a single summary
+    reply per chat and a single log entry per batch.
+    """
+
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, linger=INGEST_LINGER, queue_size=INGEST_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.bot = None
+        self.running = False
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._lags = deque(maxlen=1000)
+        self._recent = deque()  # (finished monotonic, documents) for the last minute
+        self.queued = 0
+        self.saved = 0
+        self.duplicates = 0
+        self.too_large = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self, bot):
+        self.bot = bot
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._worker, daemon=True, name="IngestWorker")
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Stop the worker after it has cataloged everything already queued."""
+        self.running = False
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, message, chat_id):
+        """Queue message's document; blocks while the queue is full."""
+        doc = message.document
+        self.queue.put({
+            'file_id': doc.file_id,
+            'file_unique_id': doc.file_unique_id,
+            'original_filename': doc.file_name or f"{doc.file_unique_id}.pdf",
+            'file_size': doc.file_size or 0,
+            'message_id': message.message_id,
+            'channel_id': chat_id,
+            'queued_at': time.monotonic(),
+        })
+        with self._stats_lock:
+            self.queued += 1
+
+    def _collect(self):
+        try:
+            batch = [self.queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while self.running or not self.queue.empty():
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.exception(f"Ingest batch of {len(batch)} failed: {e}")
+                with self._stats_lock:
+                    self.failed += len(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _process(self, batch):
+        by_chat = defaultdict(list)
+        for entry in batch:
+            by_chat[entry['channel_id']].append(entry)
+
+        totals = {'saved': 0, 'duplicates': 0}
+        too_large = []
+        for chat_id, entries in by_chat.items():
+            large = [e for e in entries if e['file_size'] > MAX_FILE_SIZE]
+            saved, duplicates = add_files([e for e in entries if e['file_size'] <= MAX_FILE_SIZE])
+            totals['saved'] += saved
+            totals['duplicates'] += duplicates
+            too_large.extend(large)
+            summary = f"✅ {saved} saved, {duplicates} duplicates"
+            if large:
+                summary += f", {len(large)} too large"
+            try:
+                safe_send_message(self.bot, chat_id, summary, reply_to_message_id=entries[-1]['message_id'])
+            except Exception as e:
+                # The files are already saved; a chat we can't reply in mustn't hold up the others
+                logger.warning(f"Ingest summary to {chat_id} failed: {e}")
+
+        finished = time.monotonic()
+        with self._stats_lock:
+            self.saved += totals['saved']
+            self.duplicates += totals['duplicates']
+            self.too_large += len(too_large)
+            self.batches += 1
+            self._lags.extend(finished - entry['queued_at'] for entry in batch)
+            self._recent.append((finished, len(batch)))
+
+        logger.info(f"📚 Ingest batch: {totals['saved']} saved, {totals['duplicates']} duplicates, "
+                    f"{len(too_large)} too large")
+        log_text = f"📚 New PDFs: {totals['saved']} saved, {totals['duplicates']} duplicates"
+        if too_large:
+            names = ", ".join(f"{e['original_filename']} ({format_size(e['file_size'])})" for e in too_large[:5])
+            log_text += f"\n🚫 Ignored {len(too_large)} large files: {names}"
+        try:
+            log_to_channel(self.bot, log_text)
+        except Exception as e:
+            logger.warning(f"Ingest log entry failed: {e}")
+
+    def stats(self):
+        with self._stats_lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0][0] > 60:
+                self._recent.popleft()
+            lags = sorted(self._lags)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queued": self.queued,
+                "saved": self.saved,
+                "duplicates": self.duplicates,
+                "too_large": self.too_large,
+                "failed": self.failed,
+                "batches": self.batches,
+                "per_minute": sum(count for _, count in self._recent),
+                "lag_p50": lags[len(lags) // 2] if lags else 0.0,
+                "lag_p95": lags[int(len(lags) * 0.95)] if lags else 0.0,
+            }
+
+ingest_pipeline = IngestPipeline()
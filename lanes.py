@@ -0,0 +1,86 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher that handles updates from different chats concurrently.
+
+    Every update is hashed by chat (or by user, for chat-less updates such as
+    inline queries) onto one of `lanes` worker threads. A lane runs its
+    updates one at a time, so a chat's updates keep their order, while a slow
+    handler only delays the chats that share its lane. With lanes=0 updates
+    are handled on the dispatcher thread as before.
+    """
+
+    def __init__(self, *args, lanes=4, lane_queue_size=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane_queues = [queue.Queue(maxsize=lane_queue_size) for _ in range(lanes)]
+        self._lane_threads = []
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.processed = 0
+
+    @staticmethod
+    def lane_key(update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return update.update_id
+
+    def start(self, ready=None):
+        if not self.running and not self._lane_threads:
+            for i, lane in enumerate(self.lane_queues):
+                thread = threading.Thread(target=self._lane_worker, args=(lane,), daemon=True,
+                                          name=f"UpdateLane-{i}")
+                thread.start()
+                self._lane_threads.append(thread)
+        super().start(ready)
+
+    def stop(self):
+        """Stop taking updates, then let every lane finish what it has queued."""
+        super().stop()
+        for lane in self.lane_queues:
+            lane.put(None)
+        for thread in self._lane_threads:
+            thread.join()
+        self._lane_threads = []
+
+    def process_update(self, update):
+        if not self._lane_threads or not isinstance(update, Update):
+            return super().process_update(update)
+        lane = self.lane_queues[hash(self.lane_key(update)) % len(self.lane_queues)]
+        lane.put((update, time.monotonic()))  # blocks while the lane is full
+
+    def _lane_worker(self, lane):
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            update, queued_at = item
+            try:
+                super().process_update(update)
+            except Exception as e:
+                logger.exception(f"Update {update.update_id} failed in its lane: {e}")
+            with self._stats_lock:
+                self.processed += 1
+                self._latencies.append(time.monotonic() - queued_at)
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            depths = [lane.qsize() for lane in self.lane_queues]
+            return {
+                "lanes": len(self.lane_queues),
+                "queued": sum(depths),
+                "busiest_lane": max(depths) if depths else 0,
+                "processed": self.processed,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+                "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            }
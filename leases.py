@@ -0,0 +1,129 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from config import LEASE_TTL, LEASE_RETRY_INTERVAL
+import database
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process in lease rows, e.g. "web-1:4242:9f1c2a"
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class SQLiteLeaseBackend:
+    """Leases stored in the bot database, shared by every process on the same volume.
+
+    A backend needs three methods: try_acquire(name, holder, ttl) returning a
+    generation or None, release(name, holder), and list() of lease dicts.
+    Anything with that shape (e.g. a Redis-backed class) can be passed to Lease.
+    """
+
+    def try_acquire(self, name, holder, ttl):
+        return database.try_acquire_lease(name, holder, ttl)
+
+    def release(self, name, holder):
+        database.release_lease(name, holder)
+
+    def list(self):
+        return database.get_leases()
+
+default_backend = SQLiteLeaseBackend()
+
+class Lease:
+    """A named lease this process holds for as long as its heartbeat keeps renewing it.
+
+    The heartbeat renews every ttl/3 seconds. If a renewal fails, or the last
+    successful one is older than ttl, `held` turns False and on_lost is called,
+    so the work it guards can stop before another process takes over.
+    """
+
+    def __init__(self, name, ttl=LEASE_TTL, backend=None, on_lost=None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend or default_backend
+        self.on_lost = on_lost
+        self.generation = None
+        self._renewed_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def held(self):
+        return self.generation is not None and time.monotonic() - self._renewed_at < self.ttl
+
+    def _try(self):
+        try:
+            generation = self.backend.try_acquire(self.name, HOLDER_ID, self.ttl)
+        except Exception as e:
+            logger.error(f"Lease '{self.name}' renewal failed: {e}")
+            return False
+        if generation is None:
+            return False
+        self.generation = generation
+        self._renewed_at = time.monotonic()
+        return True
+
+    def acquire(self, blocking=False, keep_waiting=None):
+        """Take the lease; if blocking, retry until it is free or keep_waiting() turns False."""
+        while not self._try():
+            if not blocking or (keep_waiting and not keep_waiting()):
+                return False
+            time.sleep(LEASE_RETRY_INTERVAL)
+        logger.info(f"🔑 Lease '{self.name}' acquired (generation {self.generation})")
+        # A heartbeat left over from an earlier hold must exit before the new one starts
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True, name=f"Lease-{self.name}")
+        self._thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            if self._try():
+                continue
+            if not self.held:
+                logger.warning(f"⚠️ Lease '{self.name}' lost")
+                self.generation = None
+                if self.on_lost:
+                    self.on_lost()
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.generation is not None:
+            self.generation = None
+            try:
+                self.backend.release(self.name, HOLDER_ID)
+            except Exception as e:
+                logger.error(f"Lease '{self.name}' release failed: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def run_exclusive(name, func, *args, ttl=LEASE_TTL, **kwargs):
+    """Run func under lease `name` unless another process holds it; returns False if skipped."""
+    lease = Lease(name, ttl)
+    if not lease.acquire():
+        logger.info(f"⏭️ Skipping '{name}': another process holds its lease")
+        return False
+    with lease:
+        func(*args, **kwargs)
+    return True
+
+def lease_status():
+    """Every lease row, with seconds left and whether this process holds it."""
+    now = time.time()
+    leases = default_backend.list()
+    for lease in leases:
+        lease['expires_in'] = max(0.0, lease.pop('expires_at') - now)
+        lease['mine'] = lease['holder'] == HOLDER_ID
+    return leases
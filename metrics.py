@@ -0,0 +1,166 @@
+"""In-process metrics rendered in the Prometheus text format at /metrics."""
+import functools
+import threading
+import time
+from telegram.ext import CommandHandler, DispatcherHandlerStop
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        """{label values: (per-bucket counts, sum, count)} as of now."""
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class Gauge:
+    """A value read from a callback at scrape time; it may return a number or {label value: number}."""
+
+    def __init__(self, name, documentation, func, labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelname = labelname
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.func()
+        except Exception:
+            return lines  # a broken source shouldn't take down the whole scrape
+        if isinstance(value, dict):
+            for label, item in sorted(value.items()):
+                lines.append(f"{self.name}{_labels([self.labelname], [label])} {item}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ==================== Bot metrics ====================
+
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Time spent in each update handler.", ["handler"])
+HANDLER_CALLS = Counter("bot_handler_calls_total", "Update handler invocations by outcome.", ["handler", "outcome"])
+DB_LATENCY = Histogram("bot_db_session_seconds", "Time each outermost get_db() block held its connection.",
+                       ["mode"], buckets=DB_BUCKETS)
+API_LATENCY = Histogram("bot_api_request_seconds", "Bot API request latency by method.", ["method"])
+API_CALLS = Counter("bot_api_calls_total", "Bot API requests by method.", ["method"])
+API_RETRY_AFTER = Counter("bot_api_retry_after_total", "Bot API flood-control (RetryAfter) errors by method.", ["method"])
+
+def handler_name(handler):
+    if isinstance(handler, CommandHandler):
+        return f"/{handler.command[0]}"
+    callback = handler.callback
+    return f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+
+def instrument_handler(handler):
+    """Wrap handler's callback so every call is counted and timed; returns the handler."""
+    # Module-level handlers are registered again after a lease handover: wrap the original, not our wrapper
+    callback = getattr(handler.callback, 'instrumented_callback', handler.callback)
+    name = handler_name(handler)
+
+    @functools.wraps(callback)
+    def timed(update, context):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return callback(update, context)
+        except DispatcherHandlerStop:
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+            HANDLER_CALLS.inc(handler=name, outcome=outcome)
+
+    timed.instrumented_callback = callback
+    handler.callback = timed
+    return handler
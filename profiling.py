@@ -0,0 +1,159 @@
+"""On-demand profiling: stack sampling, tracemalloc diffs and a memory breakdown."""
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+import database
+import utils
+from reactions import reaction_dispatcher
+from ingest import ingest_pipeline
+
+# Leaf frames in these files mean the thread is parked waiting for work
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py')
+
+_capture_lock = threading.Lock()
+
+def _thread_group(name):
+    """UpdateLane-3 and UpdateLane-7 are reported together as UpdateLane."""
+    return re.sub(r'[-_:]?\d+$', '', name) or name
+
+def _frame_label(code, lineno=None):
+    location = f"{os.path.basename(code.co_filename)}:{lineno or code.co_firstlineno}"
+    return f"{code.co_name} ({location})"
+
+def sample_stacks(seconds, interval=0.005):
+    """Sample every thread's stack for `seconds`; returns aggregated counters."""
+    me = threading.get_ident()
+    self_samples = Counter()   # leaf function -> samples
+    cumulative = Counter()     # function anywhere on the stack -> samples
+    groups = defaultdict(lambda: {'threads': set(), 'samples': 0, 'busy': 0})
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            group = groups[_thread_group(names.get(ident, str(ident)))]
+            group['threads'].add(ident)
+            group['samples'] += 1
+            if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                continue
+            group['busy'] += 1
+            self_samples[_frame_label(frame.f_code, frame.f_lineno)] += 1
+            seen = set()
+            while frame is not None:
+                label = _frame_label(frame.f_code)
+                if label not in seen:
+                    seen.add(label)
+                    cumulative[label] += 1
+                frame = frame.f_back
+        rounds += 1
+        time.sleep(interval)
+    return {'rounds': rounds, 'self': self_samples, 'cumulative': cumulative, 'groups': groups}
+
+def _deep_size(obj, seen=None):
+    """Approximate bytes held by obj and everything it references through containers."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+def memory_breakdown():
+    """RSS plus the approximate size and entry count of each in-process cache and queue."""
+    with database._pending_lock:
+        pending = (dict(database._pending_users), list(database._pending_downloads))
+    with utils._admin_rosters_lock:
+        rosters = dict(utils._admin_rosters)
+    with database._random_lock:
+        random_pools = sum(ids.itemsize * len(ids) for _, ids in database._random_pools.values())
+        random_ids = sum(len(ids) for _, ids in database._random_pools.values())
+    subsystems = {
+        "search cache": (len(database.search_cache), _deep_size(database.search_cache.snapshot())),
+        "subscription cache": (len(utils.subscription_cache), _deep_size(utils.subscription_cache.snapshot())),
+        "search sessions": (len(utils.search_sessions), _deep_size(utils.search_sessions.snapshot())),
+        "random pools": (random_ids, random_pools),
+        "settings cache": (len(database._settings_cache['banned']), _deep_size(database._settings_cache)),
+        "write-behind buffers": (len(pending[0]) + len(pending[1]), _deep_size(pending)),
+        "admin rosters": (len(rosters), _deep_size(rosters)),
+        "reaction queue": (reaction_dispatcher.depth(), _deep_size(list(reaction_dispatcher.queue.queue))
+                           + _deep_size(list(reaction_dispatcher._deferred))),
+        "ingest queue": (ingest_pipeline.queue.qsize(), _deep_size(list(ingest_pipeline.queue.queue))),
+    }
+    return {
+        "rss_mb": utils.get_memory_usage(),
+        "db_connections": len(database._connections),
+        "traced_mb": tracemalloc.get_traced_memory()[0] / (1024 * 1024) if tracemalloc.is_tracing() else None,
+        "subsystems": subsystems,
+    }
+
+def format_memory_breakdown(breakdown):
+    lines = []
+    if breakdown['rss_mb'] is not None:
+        lines.append(f"RSS: {breakdown['rss_mb']:.1f} MB")
+    if breakdown['traced_mb'] is not None:
+        lines.append(f"Traced since tracemalloc started: {breakdown['traced_mb']:.1f} MB")
+    lines.append(f"SQLite connections: {breakdown['db_connections']}")
+    for name, (entries, size) in sorted(breakdown['subsystems'].items(), key=lambda item: -item[1][1]):
+        lines.append(f"{name:<22} {entries:>8} entries  {size / 1024:>10.1f} KB")
+    return lines
+
+def profiling_busy():
+    return _capture_lock.locked()
+
+def capture_profile(seconds=10, top=25):
+    """Sample all threads and trace allocations for `seconds`; returns a plain-text report.
+
+    Returns None if another capture is already running.
+    """
+    if not _capture_lock.acquire(blocking=False):
+        return None
+    try:
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        started = time.time()
+        samples = sample_stacks(seconds)
+        after = tracemalloc.take_snapshot()
+        allocations = after.compare_to(before, 'lineno')[:top]
+        breakdown = memory_breakdown()
+        if not was_tracing:
+            tracemalloc.stop()
+    finally:
+        _capture_lock.release()
+
+    lines = [
+        f"Profile of pid {os.getpid()} at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))}",
+        f"{seconds}s, {samples['rounds']} sampling rounds",
+        "",
+        "== Threads ==",
+    ]
+    for name, group in sorted(samples['groups'].items(), key=lambda item: -item[1]['busy']):
+        busy = group['busy'] / group['samples'] if group['samples'] else 0
+        lines.append(f"{name:<32} x{len(group['threads']):<3} busy {busy:6.1%}")
+
+    busy_samples = sum(samples['self'].values()) or 1
+    for title, counter in (("Hot functions (self)", samples['self']),
+                           ("Hot functions (cumulative)", samples['cumulative'])):
+        lines += ["", f"== {title} ==", f"{'samples':>8} {'share':>6}  function"]
+        for label, count in counter.most_common(top):
+            lines.append(f"{count:>8} {count / busy_samples:>6.1%}  {label}")
+
+    lines += ["", "== Allocations during capture (tracemalloc diff) =="]
+    for stat in allocations:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / 1024:>+10.1f} KB {stat.count_diff:>+8} blocks  "
+                     f"{os.path.basename(frame.filename)}:{frame.lineno}")
+
+    lines += ["", "== Memory =="] + format_memory_breakdown(breakdown)
+    return "\n".join(lines) + "\n"
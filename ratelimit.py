@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+from metrics import API_CALLS, API_LATENCY, API_RETRY_AFTER
+from config import API_GLOBAL_RATE, API_PRIVATE_CHAT_RATE, API_GROUP_CHAT_RATE_PER_MIN, API_CHAT_BURST
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Allows `rate` operations per second, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait=None):
+        """Take a token and return how long the caller must sleep before using it.
+
+        Returns None without taking a token if the wait would exceed max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.paused_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def refund(self):
+        """Give back a token taken by reserve() that ended up unused."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` (e.g. after a flood-control error)."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self.tokens >= self.capacity and self.paused_until <= now
+
+class KeyedBuckets:
+    """One TokenBucket per key (e.g. chat id), created on demand and pruned when idle."""
+
+    def __init__(self, rate, capacity=None, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    for idle_key in [k for k, b in self._buckets.items() if b.idle()]:
+                        del self._buckets[idle_key]
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            return bucket
+
+    def __len__(self):
+        return len(self._buckets)
+
+class RateGovernor:
+    """Paces every outbound Bot API call against Telegram's limits.
+
+    A global bucket caps total sends per second, per-chat buckets cap sends
+    into one chat (private chats and groups have different limits), and a
+    RetryAfter from any call pauses everything for the requested window.
+    """
+
+    def __init__(self, global_rate, private_rate, group_rate, chat_burst):
+        self.global_bucket = TokenBucket(global_rate)
+        self.private_buckets = KeyedBuckets(private_rate, capacity=chat_burst)
+        self.group_buckets = KeyedBuckets(group_rate, capacity=chat_burst)
+        self._stats_lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+        self.retry_after_count = 0
+
+    def _chat_bucket(self, chat_id):
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # @channelusername targets are channels/groups
+            return self.group_buckets.get(chat_id)
+        return self.private_buckets.get(chat_id) if chat_id > 0 else self.group_buckets.get(chat_id)
+
+    def acquire(self, chat_id=None, max_wait=None):
+        """Block until a call into chat_id (or a chat-less call) may go out.
+
+        Returns False without waiting if that would take longer than max_wait.
+        """
+        wait = self.global_bucket.reserve(max_wait)
+        if wait is None:
+            return False
+        if chat_id is not None:
+            chat_wait = self._chat_bucket(chat_id).reserve(max_wait)
+            if chat_wait is None:
+                self.global_bucket.refund()  # the call isn't going out, so it shouldn't count
+                return False
+            wait = max(wait, chat_wait)
+        with self._stats_lock:
+            self.calls += 1
+            if wait:
+                self.throttled += 1
+                self.waited_seconds += wait
+        if wait:
+            time.sleep(wait)
+        return True
+
+    def backoff(self, seconds, chat_id=None):
+        """Record a RetryAfter: hold all calls (and the chat's, if known) for `seconds`."""
+        self.global_bucket.pause(seconds)
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(seconds)
+        with self._stats_lock:
+            self.retry_after_count += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "waited_seconds": self.waited_seconds,
+                "retry_after": self.retry_after_count,
+                "backoff_remaining": max(0.0, self.global_bucket.paused_until - time.monotonic()),
+            }
+
+rate_governor = RateGovernor(API_GLOBAL_RATE, API_PRIVATE_CHAT_RATE,
+                             API_GROUP_CHAT_RATE_PER_MIN / 60.0, API_CHAT_BURST)
+
+# Methods that post into a chat and count against that chat's limit
+CHAT_SCOPED_PREFIXES = ('send', 'edit', 'forward', 'copy')
+# Chat-scoped methods that only count against the global limit
+UNSCOPED_METHODS = {'sendChatAction', 'deleteMessage'}
+
+class GovernedRequest(Request):
+    """python-telegram-bot Request that routes outbound calls through rate_governor."""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        chat_id = (data or {}).get('chat_id')
+        scoped = method.startswith(CHAT_SCOPED_PREFIXES) and method not in UNSCOPED_METHODS
+        if scoped or method in UNSCOPED_METHODS:
+            rate_governor.acquire(chat_id if scoped else None)
+        API_CALLS.inc(method=method)
+        try:
+            with API_LATENCY.time(method=method):
+                return super().post(url, data, timeout=timeout)
+        except RetryAfter as e:
+            logger.warning(f"{method} hit flood control, backing off {e.retry_after}s")
+            rate_governor.backoff(e.retry_after, chat_id)
+            API_RETRY_AFTER.inc(method=method)
+            raise
@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from telegram.error import RetryAfter
+from config import REACTION_DELAY, REACTION_WORKERS, REACTION_QUEUE_SIZE, REACTION_MAX_AGE
+from ratelimit import KeyedBuckets, rate_governor
+from utils import send_reaction
+
+logger = logging.getLogger(__name__)
+
+EMOJI_POOLS = {
+    "text": ["👍", "❤️", "🔥", "🥰", "👏", "😁", "🤔", "🤯", "😱", "🎉", "🤩", "🙏", "👌", "🕊️", "🤝", "😍", "😘", "💯", "💪", "🍓"],
+    "photo": ["❤️", "🔥", "👍", "👏", "😍", "🤩", "✨", "🌟", "🎯", "🏆"],
+    "video": ["🔥", "🎬", "👍", "👏", "😎", "💯", "⚡", "🚀", "🎉", "🏅"],
+    "sticker": ["😄", "😂", "🤣", "😍", "😎", "🤩", "🎭", "✨", "👍", "👌"],
+    "document": ["📄", "📚", "📖", "🔖", "📌", "✅", "👍", "❤️", "🔥", "🎉"]
+}
+
+class ReactionDispatcher:
+    """Sends message reactions from a bounded queue using a pool of worker threads.
+
+    Each chat gets its own token bucket (one reaction per REACTION_DELAY
+    seconds). A reaction whose chat slot is still in the future waits in a
+    heap keyed on that slot while the worker moves on, so a busy chat cannot
+    starve the others, and reactions older than max_age are dropped instead
+    of landing minutes late.
+    """
+
+    def __init__(self, workers=REACTION_WORKERS, queue_size=REACTION_QUEUE_SIZE,
+                 max_age=REACTION_MAX_AGE, chat_interval=REACTION_DELAY):
+        self.workers = workers
+        self.max_age = max_age
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.chat_buckets = KeyedBuckets(rate=1.0 / chat_interval, capacity=1)
+        self.running = False
+        self._threads = []
+        self._deferred = []  # heap of (ready monotonic, seq, item) holding a reserved chat slot
+        self._deferred_lock = threading.Lock()
+        self._seq = itertools.count()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped_full = 0
+        self.dropped_stale = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True, name=f"ReactionWorker-{i}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.running = False
+
+    def submit(self, chat_id, message_id, msg_type="text"):
+        """Queue a reaction; returns False if the queue is full and it was dropped."""
+        try:
+            self.queue.put_nowait((chat_id, message_id, msg_type, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped_full += 1
+            return False
+        with self._stats_lock:
+            self.submitted += 1
+        return True
+
+    def depth(self):
+        """Reactions not yet sent: queued plus waiting for their chat's slot."""
+        return self.queue.qsize() + len(self._deferred)
+
+    def _next(self):
+        """The earliest deferred reaction that is due, else the next queued one (or None)."""
+        with self._deferred_lock:
+            now = time.monotonic()
+            if self._deferred and self._deferred[0][0] <= now:
+                return heapq.heappop(self._deferred)[2], True
+            timeout = min(1.0, self._deferred[0][0] - now) if self._deferred else 1.0
+        try:
+            return self.queue.get(timeout=timeout), False
+        except queue.Empty:
+            return None, False
+
+    def _worker(self):
+        while self.running:
+            item, reserved = self._next()
+            if item is None:
+                continue
+            try:
+                self._deliver(*item, reserved=reserved)
+            except Exception as e:
+                logger.error(f"Reaction worker error: {e}")
+            finally:
+                if not reserved:
+                    self.queue.task_done()
+
+    def _deliver(self, chat_id, message_id, msg_type, queued_at, reserved=False):
+        deadline = queued_at + self.max_age
+        bucket = self.chat_buckets.get(chat_id)
+        if not reserved:
+            wait = bucket.reserve(max_wait=deadline - time.monotonic())
+            if wait is None:
+                with self._stats_lock:
+                    self.dropped_stale += 1
+                return
+            if wait > 0:
+                # The slot is ours; park the reaction until then instead of sleeping on it
+                with self._deferred_lock:
+                    heapq.heappush(self._deferred, (time.monotonic() + wait, next(self._seq),
+                                                    (chat_id, message_id, msg_type, queued_at)))
+                return
+        # Reactions have their own per-chat limit, so they only draw on the global budget
+        if not rate_governor.acquire(max_wait=deadline - time.monotonic()):
+            bucket.refund()  # the slot went unused; let the chat's next reaction have it
+            with self._stats_lock:
+                self.dropped_stale += 1
+            return
+
+        # A bot can only hold one reaction per message, so a single call replaces
+        # the old "one or two reactions in a row" where the second overwrote the first.
+        emoji = random.choice(EMOJI_POOLS.get(msg_type, EMOJI_POOLS["text"]))
+        try:
+            ok = send_reaction(chat_id, message_id, emoji, is_big=random.choice([True, False]))
+        except RetryAfter as e:
+            logger.warning(f"Reaction flood in chat {chat_id}, pausing it for {e.retry_after}s")
+            bucket.pause(e.retry_after)
+            rate_governor.backoff(e.retry_after)
+            ok = False
+        with self._stats_lock:
+            if ok:
+                self.sent += 1
+                self._latencies.append(time.monotonic() - queued_at)
+            else:
+                self.failed += 1
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            return {
+                "queue_depth": self.depth(),
+                "deferred": len(self._deferred),
+                "queue_size": self.queue.maxsize,
+                "workers": self.workers,
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped_full": self.dropped_full,
+                "dropped_stale": self.dropped_stale,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+                "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            }
+
+reaction_dispatcher = ReactionDispatcher()
@@ -1,18 +1,34 @@
 import re
 import random
 import requests
+import threading
 import time
 from datetime import datetime
 import psutil
 from config import (
     FORCE_SUB_CHANNEL, LOG_CHANNEL, BOT_TOKEN, OWNER_ID,
-    OWNER_USERNAME, REQUEST_GROUP, MESSAGE_RETRY_DELAY
+    OWNER_USERNAME, REQUEST_GROUP, MESSAGE_RETRY_DELAY,
+    SUB_CACHE_TTL, SUB_CACHE_NEGATIVE_TTL, SUB_CACHE_SIZE, REACTION_WORKERS,
+    SEARCH_SESSION_TTL, SEARCH_SESSION_SIZE, ADMIN_ROSTER_RETRY_AFTER
 )
+from cache import TTLCache
+from metrics import API_CALLS, API_LATENCY, API_RETRY_AFTER
 import logging
 from telegram.error import RetryAfter, TimedOut
 
 logger = logging.getLogger(__name__)
 
+# Keep-alive session for raw Bot API calls that python-telegram-bot doesn't wrap
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=REACTION_WORKERS))
+
+# Force-subscribe membership by user_id; each hit is one get_chat_member call saved
+subscription_cache = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_TTL)
+
+# Query behind each results message, keyed by (chat_id, message_id). Unlike
+# user_data it is safe when a user pages two searches at once from two chats.
+search_sessions = TTLCache(SEARCH_SESSION_SIZE, SEARCH_SESSION_TTL)
+
 # ==================== FANCY FONT & DECORATION FUNCTIONS ====================
 
 def fancy_bold(text):
@@ -93,6 +109,7 @@ def random_reaction() -> str:
     return random.choice(emojis)
 
 def send_reaction(chat_id: int, message_id: int, emoji: str, is_big: bool = False, max_retries=2):
+    """Set a reaction on a message. Raises RetryAfter on flood control instead of sleeping."""
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/setMessageReaction"
     data = {
         "chat_id": chat_id,
@@ -102,27 +119,29 @@ def send_reaction(chat_id: int, message_id: int, emoji: str, is_big: bool = Fals
     if is_big:
         data["is_big"] = True
     for attempt in range(max_retries):
+        # Raw HTTP bypasses GovernedRequest, so record it in the same API metrics here
+        API_CALLS.inc(method="setMessageReaction")
         try:
-            response = requests.post(url, json=data, timeout=5)
-            result = response.json()
-            if result.get("ok"):
-                return True
-            elif "retry after" in result.get("description", "").lower():
-                wait = int(result.get("parameters", {}).get("retry_after", MESSAGE_RETRY_DELAY))
-                logger.warning(f"Reaction flood, waiting {wait}s (attempt {attempt+1}/{max_retries})")
-                time.sleep(wait)
-            elif "REACTION_INVALID" in result.get("description", ""):
-                logger.warning(f"Invalid reaction emoji: {emoji}")
-                return False
-            else:
-                logger.error(f"Reaction failed: {result}")
-                return False
+            with API_LATENCY.time(method="setMessageReaction"):
+                response = http_session.post(url, json=data, timeout=5)
+                result = response.json()
         except Exception as e:
             logger.error(f"Reaction error: {e}")
             if attempt < max_retries - 1:
                 time.sleep(MESSAGE_RETRY_DELAY)
-            else:
-                return False
+                continue
+            return False
+        if result.get("ok"):
+            return True
+        elif "retry after" in result.get("description", "").lower():
+            API_RETRY_AFTER.inc(method="setMessageReaction")
+            raise RetryAfter(int(result.get("parameters", {}).get("retry_after", MESSAGE_RETRY_DELAY)))
+        elif "REACTION_INVALID" in result.get("description", ""):
+            logger.warning(f"Invalid reaction emoji: {emoji}")
+            return False
+        else:
+            logger.error(f"Reaction failed: {result}")
+            return False
     return False
 
 def safe_send_message(bot, chat_id, text, parse_mode=None, reply_markup=None, reply_to_message_id=None, max_retries=3):
@@ -136,9 +155,8 @@ def safe_send_message(bot, chat_id, text, parse_mode=None, reply_markup=None, re
                 reply_to_message_id=reply_to_message_id
             )
         except RetryAfter as e:
-            wait = e.retry_after
-            logger.warning(f"Flood control: waiting {wait}s (attempt {attempt+1}/{max_retries})")
-            time.sleep(wait)
+            # The rate governor has already paused outbound calls, so the retry waits there
+            logger.warning(f"Flood control: retry after {e.retry_after}s (attempt {attempt+1}/{max_retries})")
         except TimedOut:
             logger.warning(f"Timeout, retrying in {MESSAGE_RETRY_DELAY}s")
             time.sleep(MESSAGE_RETRY_DELAY)
@@ -164,12 +182,84 @@ def safe_reply_text(message, text, parse_mode=None, reply_markup=None, max_retri
 def check_subscription(user_id, bot):
     if not FORCE_SUB_CHANNEL:
         return True
+    cached = subscription_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
         member = bot.get_chat_member(chat_id=FORCE_SUB_CHANNEL, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        subscribed = member.status in ['member', 'administrator', 'creator']
     except Exception as e:
         logger.error(f"Subscription check error: {e}")
         return False
+    remember_subscription(user_id, subscribed)
+    return subscribed
+
+def remember_subscription(user_id, subscribed):
+    """Cache a membership result; non-members are re-checked sooner so new joiners get in quickly."""
+    subscription_cache.set(user_id, subscribed, ttl=SUB_CACHE_TTL if subscribed else SUB_CACHE_NEGATIVE_TTL)
+
+def is_force_sub_chat(chat):
+    """True if chat is FORCE_SUB_CHANNEL, whether configured as @username or numeric id."""
+    if not FORCE_SUB_CHANNEL or chat is None:
+        return False
+    channel = FORCE_SUB_CHANNEL.strip()
+    if channel.lstrip('-').isdigit():
+        return chat.id == int(channel)
+    return bool(chat.username) and chat.username.lower() == channel.lstrip('@').lower()
+
+# ==================== ADMIN ROSTERS ====================
+# Admin user ids per chat, fetched with one get_chat_administrators call and
+# then kept fresh by refresh_admin_rosters and chat_member updates, so the
+# per-message admin check is a set lookup.
+
+_admin_rosters = {}  # chat_id -> set of admin user ids
+_admin_roster_retry = {}  # chat_id -> monotonic time to refetch a roster whose last fetch failed
+_admin_rosters_lock = threading.Lock()
+
+def refresh_admin_roster(bot, chat_id):
+    try:
+        admins = {member.user.id for member in bot.get_chat_administrators(chat_id)}
+    except Exception as e:
+        logger.error(f"Admin roster fetch failed for {chat_id}: {e}")
+        # Keep serving the last roster (or none) instead of refetching on every message
+        with _admin_rosters_lock:
+            admins = _admin_rosters.setdefault(chat_id, set())
+            _admin_roster_retry[chat_id] = time.monotonic() + ADMIN_ROSTER_RETRY_AFTER
+            return admins
+    with _admin_rosters_lock:
+        _admin_rosters[chat_id] = admins
+        _admin_roster_retry.pop(chat_id, None)
+    return admins
+
+def is_chat_admin(bot, chat_id, user_id):
+    with _admin_rosters_lock:
+        admins = _admin_rosters.get(chat_id)
+        retry_at = _admin_roster_retry.get(chat_id)
+        stale = retry_at is not None and time.monotonic() >= retry_at
+        if stale:
+            # Only this caller retries; the rest keep the fallback until it's done
+            _admin_roster_retry[chat_id] = time.monotonic() + ADMIN_ROSTER_RETRY_AFTER
+    if admins is None or stale:
+        admins = refresh_admin_roster(bot, chat_id)
+    return user_id in admins
+
+def update_admin_roster(chat_id, user_id, is_admin):
+    """Apply a single member status change to a chat's roster, if we track that chat."""
+    with _admin_rosters_lock:
+        admins = _admin_rosters.get(chat_id)
+        if admins is None:
+            return
+        if is_admin:
+            admins.add(user_id)
+        else:
+            admins.discard(user_id)
+
+def refresh_admin_rosters(context):
+    """Job callback: re-fetch the roster of every chat seen so far, including failed ones."""
+    with _admin_rosters_lock:
+        chat_ids = list(_admin_rosters)
+    for chat_id in chat_ids:
+        refresh_admin_roster(context.bot, chat_id)
 
 def log_to_channel(bot, text: str):
     if not LOG_CHANNEL: